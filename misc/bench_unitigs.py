@@ -0,0 +1,62 @@
+'''
+Time the unitig construction of the partition stage (the adjacency walk and
+find_bubble_chains of bubble_chain) on synthetic bubble chains of increasing
+length, e.g.
+
+python misc/bench_unitigs.py 1000 10000 100000 1000000 10000000
+
+Every chain alternates bubbles (negative ids) and nodes between bubbles,
+with a branching point every 1000 nodes. The previous list based dfs is
+timed as well for chains of at most 10^4 nodes, as it is quadratic.
+'''
+import sys
+import os
+import io
+import time
+import contextlib
+from collections import defaultdict
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'whdenovo'))
+from bubble_chain import adjacency, find_bubble_chains
+
+def listDfs(graph, start):
+	visited, stack = [], [start]
+	while stack:
+		vertex = stack.pop()
+		if vertex not in visited:
+			visited.append(vertex)
+			stack.extend(graph[vertex] - set(visited))
+	return visited
+
+def chain(n):
+	nodes = np.arange(1, n + 1, dtype = np.int64)
+	nodes[1::2] *= -1
+	pairs = [np.stack((nodes[:-1], nodes[1:]), axis = 1)]
+	branches = np.arange(1000, n, 1000, dtype = np.int64)
+	pairs.append(np.stack((nodes[branches], n + branches), axis = 1))
+	pairs.append(np.stack((n + branches, n + branches + 1), axis = 1))
+	return nodes.tolist(), np.concatenate(pairs)
+
+sizes = [int(float(s)) for s in sys.argv[1:]] or [1000, 10000, 100000, 1000000]
+for n in sizes:
+	nodes, pairs = chain(n)
+	start = time.time()
+	graph = adjacency.fromEdges(pairs)
+	build = time.time() - start
+	start = time.time()
+	graph.walk(graph.ends())
+	walk = time.time() - start
+	line = '%d nodes: adjacency %.3fs, walk %.3fs' % (n, build, walk)
+	if n <= 10000:
+		lists = defaultdict(set)
+		for a, b in zip(nodes, nodes[1:]):
+			lists[a].add(b)
+			lists[b].add(a)
+		start = time.time()
+		listDfs(lists, nodes[0])
+		line += ', list based dfs %.3fs' % (time.time() - start)
+	start = time.time()
+	with contextlib.redirect_stdout(io.StringIO()):
+		unitigs = find_bubble_chains(pairs, {})
+	line += ', find_bubble_chains %.3fs (%d unitigs)' % (time.time() - start, len(unitigs))
+	print(line, file = sys.stderr)
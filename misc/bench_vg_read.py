@@ -0,0 +1,44 @@
+'''
+Time the alignment reading of the partition stage (vg_reader.vg_read) on a
+subgraph of test/subgraphs, e.g.
+
+python misc/bench_vg_read.py test/subgraphs/sub5 4
+
+The .gam alignments are timed, and the json fallback too where the
+alignments were also converted with vg view -a aln.gam > aln.gam.json.
+The snarl cache goes to a temporary directory, it is built before the
+timed rounds and removed at the end.
+'''
+import sys
+import os
+import time
+import shutil
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'whdenovo'))
+from vg_reader import vg_read, readSnarls
+
+prefix = sys.argv[1]
+t = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+gams = ['%s.aln%d.gam' % (prefix, i) for i in range(3)]
+inputs = [('gam', gams)]
+if all(os.path.exists(gam + '.json') for gam in gams):
+	inputs.append(('json', [gam + '.json' for gam in gams]))
+else:
+	print('No %s.aln*.gam.json, only timing the .gam files' % prefix, file = sys.stderr)
+
+snarlCache = tempfile.mkdtemp(prefix = 'snarlcache')
+try:
+	indexDir, tmpIndex = readSnarls(prefix + '.trans', snarlCache)[2:]
+	if tmpIndex:
+		shutil.rmtree(indexDir, ignore_errors = True)
+	for name, files in inputs:
+		times = []
+		for r in range(rounds):
+			start = time.time()
+			totalAlnSet, edges, alleles_per_pos, locus_branch_mapping = vg_read(prefix + '.trans', files, t, 5, 20, snarlCache = snarlCache)
+			times.append(time.time() - start)
+		times.sort()
+		print('vg_read on %s %s with %d threads: best %.2fs, median %.2fs over %d rounds' % (prefix, name, t, times[0], times[len(times) // 2], rounds), file = sys.stderr)
+finally:
+	shutil.rmtree(snarlCache, ignore_errors = True)
@@ -36,6 +36,7 @@ setup(
 	install_requires = [
 		'xopen',
 		'networkx',
+		'numpy',
 		'pystream-protobuf',
 		'Biopython'
 	],
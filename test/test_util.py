@@ -0,0 +1,35 @@
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'whdenovo'))
+from util import aux_unitigs, canonConn
+
+unitigs = [[1, 2], [3, 4], [5, 6]]
+
+
+def confident(counts):
+	aux = aux_unitigs(unitigs)
+	for connection, n in counts:
+		aux.mergeCounts({canonConn(connection): n})
+	return aux.returnConfident(minSupport = 1)
+
+
+def test_tie_within_pair():
+	# Two kinds of connection between unitigs 0 and 1 with the same
+	# support: the larger canonical connection, ((0, 1), (1, 1)), is taken
+	# whichever was counted first.
+	counts = [(((0, 1), (1, -1)), 5), (((0, 1), (1, 1)), 5)]
+	assert confident(counts) == [[1, 2, 3, 4]]
+	assert confident(counts[::-1]) == [[1, 2, 3, 4]]
+
+
+def test_tie_between_pairs():
+	# Both connections use the end of unitig 0, only the larger canonical
+	# one, ((0, 1), (2, 1)), is taken.
+	counts = [(((0, 1), (1, 1)), 5), (((0, 1), (2, 1)), 5)]
+	assert confident(counts) == [[1, 2, 5, 6]]
+	assert confident(counts[::-1]) == [[1, 2, 5, 6]]
+
+
+def test_support_before_ties():
+	counts = [(((0, 1), (1, 1)), 6), (((0, 1), (2, 1)), 5)]
+	assert confident(counts) == [[1, 2, 3, 4]]
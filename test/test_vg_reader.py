@@ -0,0 +1,68 @@
+import sys
+import os
+import io
+import gzip
+import json
+import contextlib
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'whdenovo'))
+from vg_reader import vg_read
+from bubble_chain import find_bubble_chains
+
+subgraphs = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'subgraphs')
+
+
+# Output of vg_read and find_bubble_chains on sub5 before the alignment
+# reading was reworked. Reads are sorted by name in each sample, unitigs are
+# sorted and each is read in the direction that sorts first.
+@pytest.fixture(scope = 'module')
+def baseline():
+	with gzip.open(os.path.join(subgraphs, 'sub5.baseline.json.gz'), 'rt') as f:
+		return json.load(f)
+
+
+@pytest.fixture(scope = 'module')
+def sub5(tmp_path_factory):
+	snarlCache = str(tmp_path_factory.mktemp('snarlcache'))
+	gams = [os.path.join(subgraphs, 'sub5.aln%d.gam' % i) for i in range(3)]
+	with contextlib.redirect_stdout(io.StringIO()):
+		totalAlnSet, edges, alleles_per_pos, locus_branch_mapping = vg_read(os.path.join(subgraphs, 'sub5.trans'), gams, 2, 5, 20, snarlCache = snarlCache)
+		unitigs = find_bubble_chains(edges, locus_branch_mapping)
+	return totalAlnSet, edges, alleles_per_pos, locus_branch_mapping, unitigs
+
+
+def sampleReads(store):
+	# (name, partials, alleles) of every read of a readStore, sorted.
+	partialOffsets, nodeOffsets, nodes = store.partialOffsets.tolist(), store.nodeOffsets.tolist(), store.nodes.tolist()
+	alleleOffsets, alleleLoci, alleleIdx = store.alleleOffsets.tolist(), store.alleleLoci.tolist(), store.alleleIdx.tolist()
+	reads = []
+	for i, name in enumerate(store.names):
+		partials = [nodes[nodeOffsets[j]:nodeOffsets[j + 1]] for j in range(partialOffsets[i], partialOffsets[i + 1])]
+		alleles = [[alleleLoci[k], alleleIdx[k]] for k in range(alleleOffsets[i], alleleOffsets[i + 1])]
+		reads.append([name, partials, alleles])
+	return sorted(reads)
+
+
+def test_reads(sub5, baseline):
+	totalAlnSet = sub5[0]
+	assert [sampleReads(store) for store in totalAlnSet.fullReadList] == baseline['reads']
+
+
+def test_edges(sub5, baseline):
+	edges = sub5[1]
+	assert sorted(sorted(int(n) for n in e) for e in edges) == baseline['edges']
+
+
+def test_unitigs(sub5, baseline):
+	unitigs = sub5[4]
+	assert sorted(min(list(u), list(reversed(u))) for u in unitigs) == baseline['unitigs']
+
+
+def test_alleles_per_pos(sub5, baseline):
+	alleles_per_pos = sub5[2]
+	assert sorted([int(k), v] for k, v in alleles_per_pos.items()) == baseline['alleles_per_pos']
+
+
+def test_locus_branch_mapping(sub5, baseline):
+	locus_branch_mapping = sub5[3]
+	assert [[int(k), [[list(e) for e in path] for path in bubble]] for k, bubble in locus_branch_mapping.items()] == baseline['locus_branch_mapping']
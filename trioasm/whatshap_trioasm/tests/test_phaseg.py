@@ -0,0 +1,39 @@
+import os
+import json
+import signal
+from argparse import ArgumentParser
+from pytest import raises
+import whatshap.phaseg as phaseg
+
+
+def fake_bc(*args):
+	for block_id in range(6):
+		names = ['read%d_%d' % (block_id, i) for i in range(3)]
+		yield block_id, [names, names, names], {1: 2, 2: 2}
+
+
+def fake_run_phaseg(block_id, prefix, locus_file, use_ped_samples, block_readsets):
+	# The worker phasing block 2 is killed, as by the OOM killer.
+	if block_id == 2:
+		os.kill(os.getpid(), signal.SIGKILL)
+	return [(name, block_id, i % 2, 2) for i, name in enumerate(block_readsets[2])]
+
+
+def test_killed_worker(monkeypatch, tmpdir):
+	monkeypatch.setattr(phaseg, 'bc', fake_bc)
+	monkeypatch.setattr(phaseg, 'run_phaseg', fake_run_phaseg)
+	parser = ArgumentParser()
+	phaseg.add_arguments(parser)
+	report = str(tmpdir.join('report.json'))
+	table = str(tmpdir.join('partition.tsv'))
+	args = parser.parse_args(['reads', 'ped', 'locus', 'aln0.gam', 'aln1.gam', 'aln2.gam', '-t', '2',
+		'--report', report, '--partition-table', table])
+	with raises(SystemExit) as e:
+		phaseg.main(args)
+	assert e.value.code == 1
+	with open(report) as f:
+		blocks = json.load(f)['blocks']
+	assert sorted(b['block'] for b in blocks if b['failed']) == [2]
+	assert sorted(b['block'] for b in blocks if not b['failed']) == [0, 1, 3, 4, 5]
+	with open(table) as f:
+		assert sorted(set(line.split('\t')[1] for line in f)) == ['0', '1', '3', '4', '5', 'block']
@@ -35,7 +35,15 @@ for p in sys.path:
         src = p.split('WHdenovo')[0] + 'WHdenovo/whdenovo'
 sys.path.append(src)
 from bubble_chain import bc
-from multiprocessing import Pool
+from multiprocessing import Pool, SimpleQueue
+import queue
+import os
+import pickle
+import time
+import traceback
+import resource
+import json
+from .timer import ResourceTimer
 
 
 __author__ = "Shilpa Garg"
@@ -125,7 +133,9 @@ def find_components(phased_positions, reads, master_block=None, heterozygous_pos
     return components
 
 
-def haplotag(pred_superreads, read_set, components, ap, locus_file, iteration, f):
+def haplotag(pred_superreads, read_set, components, ap, locus_file, iteration, rows):
+    # Append (read name, phase set, haplotype, number of variants) of every
+    # tagged read to rows.
     phases = []
     
     for s1,s2 in zip(*pred_superreads):
@@ -185,7 +195,7 @@ def haplotag(pred_superreads, read_set, components, ap, locus_file, iteration, f
                     phaseset = components[variant.position] + 1
                     break
         try:
-            print(read.name, str(locus_file)+ str(phaseset), read_to_haplotype[read.name][2], len(read), file=f)
+            rows.append((read.name, phaseset, read_to_haplotype[read.name][2], len(read)))
         except:
             pass
 def find_largest_component(components):
@@ -284,11 +294,16 @@ def reverse_complement(seq):
 
 def process_readset(Rawreadset, sample):
 
+    # Rawreadset is a bubble_chain.blockReadset, with the variants of all
+    # reads in flat arrays.
     readset = ReadSet()
-    for r in Rawreadset:
-        read = Read(r[0], 0, 0, sample)
-        for v in r[1:]:
-            read.add_variant(v[0], v[1], 1)
+    offsets = Rawreadset.offsets.tolist()
+    positions = Rawreadset.positions.tolist()
+    alleles = Rawreadset.alleles.tolist()
+    for i, name in enumerate(Rawreadset.names):
+        read = Read(name, 0, 0, sample)
+        for k in range(offsets[i], offsets[i + 1]):
+            read.add_variant(positions[k], alleles[k], 1)
         readset.add(read)
     readset1 = ReadSet()
     tmp_duplicated = set()
@@ -397,14 +412,15 @@ def run_phaseg(read_list_filename, prefix, locus_file, use_ped_samples, block_re
     components = defaultdict()
     #print('homozygous in an sample master block', locus_file, master_block)
     # Superreads in superreads_list are in the same order as individuals were added to the pedigree
-    f = open("%s_block_%d.allreads"%(prefix, read_list_filename), 'w')
+    rows = []
     for sample, sample_superreads in zip([0,1,2], superreads_list):
         components[sample] = overall_components
-        haplotag(sample_superreads, total_readsets[sample], components[sample], accessible_positions, read_list_filename, 1, f)
+        haplotag(sample_superreads, total_readsets[sample], components[sample], accessible_positions, read_list_filename, 1, rows)
 
     
     #if read_list_filename:
     #    write_read_list(all_reads, dp_table.get_optimal_partitioning(), components, {0:0, 1:1, 2:2}, read_list_filename)
+    return rows
 
 def add_arguments(parser):
    arg = parser.add_argument
@@ -413,21 +429,195 @@ def add_arguments(parser):
    arg('use_ped_samples', metavar = 'PED', help = 'Only work on samples mentioned in the provided PED file.')
    arg('locus_file', metavar = 'LOCUS', help = 'variants in LOCUS file to phase')
    arg('phase_input_files', nargs = 3, metavar = 'PHASEINPUT',
-       help='BAM, CRAM or VCF file(s) with phase information, either through '
-           'sequencing reads (BAM/CRAM) or through phased blocks (VCF)') # TODO for ref based  the number is changed
-   arg('-p', '--prefix', metavar = 'STR', required = False, help = 'Output partitioning results for each block into files with this prefix.')
+       help='GAM file(s) with read alignments to the graph, in the order of MOM, DAD, CHILD. '
+           'JSON converted by `vg view -a` is also accepted') # TODO for ref based  the number is changed
+   arg('-p', '--prefix', metavar = 'STR', required = False, help = 'Write the partitioning results of all blocks to PREFIX.partition.tsv.gz, '
+       'unless --partition-table is given.')
    arg('-t', '--threads', metavar = 'INT', type = int, required = False, default = 4, help = 'Number of threads to use. [4]')
    arg('--lowc', metavar = 'INT', type = int, default = 5, help = 'Lowest threshold for coverage to support edges.')
    arg('--highc', metavar = 'INT', type = int, default = 20, help = 'Highest threshold for coverage to detect repeats.')
+   arg('--spill-dir', metavar = 'PATH', default = None, help = 'Sort the partial alignments externally, spilling sorted runs to PATH '
+       'instead of holding them in memory until all input is read.')
+   arg('--snarl-cache', metavar = 'PATH', default = None, help = 'Directory caching the parsed snarl traversals of LOCUS, reused while '
+       'LOCUS is unchanged. An existing directory that holds no cache is kept, the cache goes in its subdirectory '
+       'snarls. By default the traversals are parsed again on every run.')
+   arg('--chain-graph', metavar = 'FILE', default = None, help = 'Write the graph of bubble chains joined by reads to FILE in GraphML, '
+       'for debugging. Needs networkx.')
+   arg('--min-support', metavar = 'INT', type = int, default = 5, help = 'Minimum number of reads supporting a connection '
+       'between two bubble chains for joining them. [5]')
+   arg('--support-table', metavar = 'FILE', default = None, help = 'Write the number of reads supporting each connection between '
+       'bubble chains to FILE as TSV.')
+   arg('--partition-table', metavar = 'FILE', default = None, help = 'Write the partitioning results of all blocks to FILE as TSV, '
+       'with read, block, phase set, haplotype and number of variants columns. Compressed if FILE ends with .gz, .bz2 or .xz.')
+   arg('--report', metavar = 'FILE', default = None, help = 'Write the wall time, CPU time and peak RSS of every step and of the '
+       'phasing of every block to FILE as JSON.')
+   arg('--haplotype-reads', nargs = 2, metavar = ('HP0', 'HP1'), default = None, help = 'Write the distinct names of the reads '
+       'assigned to haplotype 0 and 1 in any block to HP0 and HP1, sorted.')
+def attach_started(started):
+    # Pool initializer: workers tell main when they start and which block
+    # they are phasing, so that a block is reported as failed when its
+    # worker dies.
+    global block_started
+    block_started = started
+    started.put((None, os.getpid()))
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+def phase_block(task):
+    # Phase one block in a pool worker. Returns the block id, the wall and
+    # CPU time it took, the peak RSS of the worker so far, the traceback if
+    # it failed, so that a failing block is reported by main while the other
+    # blocks are still phased, and the partitioning rows of run_phaseg.
+    # The arguments of run_phaseg come pickled, and are only unpickled once
+    # main knows which worker has the block.
+    block_id, arguments = task
+    block_started.put((block_id, os.getpid()))
+    start = time.time()
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    error = None
+    rows = []
+    try:
+        rows = run_phaseg(block_id, *pickle.loads(arguments))
+    except Exception:
+        error = traceback.format_exc()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime - before.ru_utime - before.ru_stime
+    return task[0], time.time() - start, cpu, usage.ru_maxrss, error, rows
+
 def main(args):
-    total_readsets, alleles_per_pos = bc(args.locus_file, args.phase_input_files, args.threads, args.lowc, args.highc)
-    child_c = 0
-    for b in total_readsets:
-        child_c += len(b[2])    
-    print('after bc step: child readset size', child_c)
-    p = Pool(args.threads)
-    results = []
-    for block_id in range(len(total_readsets)):
-        p.apply_async(func=run_phaseg, args=(block_id, args.prefix, args.locus_file, args.use_ped_samples, total_readsets[block_id]))
-    p.close()
-    p.join()
+    timers = ResourceTimer()
+    timers.start('overall')
+    blocks = bc(args.locus_file, args.phase_input_files, args.threads, args.lowc, args.highc, args.spill_dir, args.snarl_cache, args.chain_graph,
+                args.min_support, args.support_table, timers)
+    sizes = dict()
+    def tasks():
+        # Blocks are handed to the workers as soon as their readsets are
+        # built, at most 2 per thread ahead of the phasing. bc gives the
+        # largest blocks first.
+        child_c = 0
+        for block_id, block_readsets, alleles_per_pos in blocks:
+            child_c += len(block_readsets[2])
+            sizes[block_id] = (sum(len(readset) for readset in block_readsets), len(alleles_per_pos))
+            yield (block_id, pickle.dumps((args.prefix, args.locus_file, args.use_ped_samples, block_readsets), pickle.HIGHEST_PROTOCOL))
+        print('after bc step: child readset size', child_c)
+    table = args.partition_table
+    if table is None and args.prefix is not None:
+        table = args.prefix + '.partition.tsv.gz'
+    out = None
+    if table is not None:
+        out = xopen(table, 'w')
+        print('read', 'block', 'phaseset', 'haplotype', 'variants', sep = '\t', file = out)
+    haplotype_reads = [set(), set()]
+    timers.start('phase_blocks')
+    times = dict()
+    block_stats = []
+    failed = []
+    def finish(block_id, seconds, cpu, max_rss, error, rows):
+        for name, phaseset, haplotype, n in rows:
+            if out is not None:
+                print(name, block_id, phaseset, haplotype, n, sep = '\t', file = out)
+            if args.haplotype_reads:
+                haplotype_reads[haplotype].add(name)
+        times[block_id] = seconds
+        reads, variants = sizes.pop(block_id)
+        block_stats.append({'block': block_id, 'reads': reads, 'variants': variants, 'seconds': seconds, 'cpu_seconds': cpu,
+                            'max_rss_kb': max_rss, 'failed': error is not None})
+        if error:
+            failed.append(block_id)
+            logger.error('Phasing block %d (%d reads, %d variants) failed after %.2fs:\n%s', block_id, reads, variants, seconds, error)
+        else:
+            logger.debug('Phased block %d (%d reads, %d variants) in %.2fs', block_id, reads, variants, seconds)
+    # Blocks are submitted with apply_async, at most 2 per thread ahead of
+    # the phasing, and their results come back through finished. The pool
+    # replaces a worker killed by a signal, e.g. by the OOM killer, but the
+    # block it was phasing never returns. Workers tell which block they
+    # start, and while no result comes a block is lost if its worker is
+    # dead. A worker that died between two blocks may have taken a block it
+    # had not told yet, so after such a death the blocks that were never
+    # started while a worker is idle are lost too. Only blocks found lost
+    # twice in a row are reported as failed, as a result sent just before a
+    # worker died may still be on its way.
+    started = SimpleQueue()
+    finished = queue.Queue()
+    p = Pool(args.threads, initializer = attach_started, initargs = (started,))
+    pending = dict()
+    workers = dict()
+    suspects = set()
+    crashed = False
+    diedIdle = False
+    todo = tasks()
+    try:
+        while True:
+            while todo is not None and len(pending) < 2 * args.threads:
+                task = next(todo, None)
+                if task is None:
+                    todo = None
+                    break
+                pending[task[0]] = time.time()
+                p.apply_async(phase_block, (task,), callback = finished.put,
+                              error_callback = lambda e, block_id = task[0]: finished.put((block_id, 0, 0, 0, repr(e), [])))
+            if not pending:
+                break
+            try:
+                result = finished.get(timeout = 1)
+            except queue.Empty:
+                result = None
+            while not started.empty():
+                block_id, pid = started.get()
+                workers[pid] = block_id
+            if result is None:
+                lost = set()
+                idle = False
+                for pid, block_id in list(workers.items()):
+                    if not alive(pid):
+                        if block_id in pending:
+                            lost.add(block_id)
+                        else:
+                            del workers[pid]
+                            diedIdle = True
+                    elif block_id not in pending:
+                        idle = True
+                if diedIdle and idle:
+                    lost.update(set(pending) - set(workers.values()))
+                for block_id in lost & suspects:
+                    finish(block_id, time.time() - pending.pop(block_id), 0, 0, 'The worker phasing the block died.', [])
+                    crashed = True
+                suspects = lost - suspects
+                continue
+            if result[0] in pending:
+                del pending[result[0]]
+                finish(*result)
+        # The pool waits for the results of lost blocks when joined.
+        if crashed:
+            p.terminate()
+        else:
+            p.close()
+            p.join()
+    except:
+        p.terminate()
+        raise
+    finally:
+        if out is not None:
+            out.close()
+    timers.stop('phase_blocks')
+    if args.haplotype_reads:
+        for names, path in zip(haplotype_reads, args.haplotype_reads):
+            with open(path, 'w') as f:
+                for name in sorted(names):
+                    print(name, file = f)
+    busy = sum(times.values())
+    logger.info('Phased %d blocks in %.1fs with %d threads, %.1fs busy', len(times), timers.elapsed('phase_blocks'), args.threads, busy)
+    for block_id in sorted(times, key = times.get, reverse = True)[:5]:
+        logger.info('Block %d took %.2fs', block_id, times[block_id])
+    timers.stop('overall')
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'threads': args.threads, 'steps': timers.report(), 'blocks': block_stats}, f, indent = 1)
+    if failed:
+        logger.error('%d blocks failed: %s', len(failed), ' '.join(map(str, sorted(failed))))
+        sys.exit(1)
@@ -1,4 +1,5 @@
 import time
+import resource
 from collections import defaultdict
 from contextlib import contextmanager
 
@@ -37,3 +38,41 @@ class StageTimer:
 		self.start(stage)
 		yield
 		self.stop(stage)
+
+
+def _usage():
+	"""CPU seconds used so far by this process and its waited-for children, and their peak RSS in kB"""
+	own = resource.getrusage(resource.RUSAGE_SELF)
+	children = resource.getrusage(resource.RUSAGE_CHILDREN)
+	cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+	return cpu, max(own.ru_maxrss, children.ru_maxrss)
+
+
+class ResourceTimer(StageTimer):
+	"""
+	StageTimer that also measures the CPU time of each stage, including that
+	of child processes such as pool workers once they are joined, and the
+	peak RSS reached by the end of it.
+	"""
+
+	def __init__(self):
+		super().__init__()
+		self._cpu_start = dict()
+		self._cpu = defaultdict(float)
+		self._max_rss = dict()
+
+	def start(self, stage):
+		self._cpu_start[stage] = _usage()[0]
+		super().start(stage)
+
+	def stop(self, stage):
+		t = super().stop(stage)
+		cpu, max_rss = _usage()
+		self._cpu[stage] += cpu - self._cpu_start[stage]
+		self._max_rss[stage] = max_rss
+		return t
+
+	def report(self):
+		"""Return the wall time, CPU time and peak RSS of every stage, in the order they were started"""
+		return [{'name': stage, 'seconds': self._elapsed[stage], 'cpu_seconds': self._cpu[stage], 'max_rss_kb': self._max_rss[stage]}
+			for stage in self._start if stage in self._max_rss]
@@ -1,233 +1,273 @@
 import sys
 from collections import defaultdict
-import networkx as nx
-from itertools import groupby
-from vg_reader import vg_read
+from itertools import groupby, chain
+from contextlib import contextmanager
+import numpy as np
+from multiprocessing import Pool
+from threading import Semaphore, Event
+from vg_reader import vg_read, getOffsets, uniqueValues, boundedTasks
 from util import *
 
-def dfs(graph, start):
-	visited, stack = [], [start]
-	while stack:
-		vertex = stack.pop()
-		if vertex not in visited:
-			visited.append(vertex)
-			stack.extend(graph[vertex] - set(visited))
-	return visited
+class adjacency(object):
+	# Undirected graph in CSR form: the neighbours of nodes[i] are
+	# nodes[neighbours[offsets[i]:offsets[i+1]]], sorted and distinct. A self
+	# loop counts as a neighbour, so a node with a self loop and one other
+	# neighbour is not the end of a unitig.
+	def __init__(self, nodes, offsets, neighbours):
+		self.nodes = nodes
+		self.offsets = offsets
+		self.neighbours = neighbours
 
-def find_bubble_chains(consec_pairs, locus_branch_mapping):
-	print('the total number of edges %d.' %len(consec_pairs))
-	consec_pairs_tmp = defaultdict(set)
-	
-	for edge in consec_pairs:
-		if edge[0] != edge[1]:
-			consec_pairs_tmp[edge[0]].add(edge[1])
-			consec_pairs_tmp[edge[1]].add(edge[0])
+	@classmethod
+	def fromEdges(cls, edges):
+		# edges are (from, to) node id pairs, in either orientation.
+		edges = np.asarray(edges, dtype = np.int64).reshape(-1, 2)
+		nodes = uniqueValues(edges)
+		n = max(len(nodes), 1)
+		src = np.searchsorted(nodes, edges[:, 0])
+		dst = np.searchsorted(nodes, edges[:, 1])
+		pairs = uniqueValues(np.concatenate((src * n + dst, dst * n + src)))
+		offsets = getOffsets(np.bincount(pairs // n, minlength = len(nodes)))
+		return cls(nodes, offsets, pairs % n)
 
-	count = 0
-	for i,j in consec_pairs_tmp.items():
-		j = list(j)
-		if len(j) > 2:
-			count += 1
-			for k in j:
-				if (i, k) in consec_pairs:
-					consec_pairs.remove((i, k))
-				if (k, i) in consec_pairs:
-					consec_pairs.remove((k, i))
+	def degrees(self):
+		return np.diff(self.offsets)
 
-	print('the total number of branching points %d.' %count)
-	print('the total number of good pairs or edges %d.' %len(consec_pairs))
+	def ends(self):
+		return np.flatnonzero(self.degrees() == 1)
 
-	# Return all distinct simple paths ending at "targetNode", continuing
-	# from "currentPath". "usedNodes" is useful so we can quickly skip
-	# nodes we have already added to "currentPath". When a new solution path
-	# is found, append it to "answerPaths" and return it.
+	def walk(self, starts):
+		# Depth first walks from each of starts (node indices) that is not
+		# reached by an earlier walk. Runs of nodes with a single unvisited
+		# neighbour, i.e. the inside of a unitig, are followed directly
+		# instead of going through the stack, so a walk is linear in the
+		# size of its component.
+		nodes = self.nodes.tolist()
+		offsets = self.offsets.tolist()
+		neighbours = self.neighbours.tolist()
+		visited = bytearray(len(nodes))
+		walks = []
+		for start in starts.tolist():
+			if visited[start]:
+				continue
+			order, stack = [], [start]
+			while stack:
+				vertex = stack.pop()
+				while not visited[vertex]:
+					visited[vertex] = 1
+					order.append(nodes[vertex])
+					nextNodes = [u for u in neighbours[offsets[vertex]:offsets[vertex + 1]] if not visited[u]]
+					if len(nextNodes) != 1:
+						stack.extend(nextNodes)
+						break
+					vertex = nextNodes[0]
+			walks.append(order)
+		return walks
 
-	nodeToNodess= defaultdict(set)
-	nodeToNodes = defaultdict(list)
-	for edge in consec_pairs:
-		nodeToNodess[edge[0]].add(edge[1])
-		nodeToNodess[edge[1]].add(edge[0])
+	def toNetworkx(self):
+		# Only for inspecting the graph, networkx is not needed otherwise.
+		import networkx as nx
+		graph = nx.Graph()
+		graph.add_nodes_from(self.nodes.tolist())
+		src = np.repeat(np.arange(len(self.nodes)), self.degrees())
+		graph.add_edges_from(zip(self.nodes[src].tolist(), self.nodes[self.neighbours].tolist()))
+		return graph
 
-	for i,j in nodeToNodess.items():
-		nodeToNodes[i] = list(j)
-	start_or_end = set()
-	for i,j in nodeToNodes.items():
-		if len(nodeToNodes[i]) ==1:
-			start_or_end.add(i)
-			
-	nx_nodeToNodes = nx.MultiDiGraph(nodeToNodes)
+def find_bubble_chains(consec_pairs, locus_branch_mapping):
+	# consec_pairs is an (n, 2) array of edges. All edges of branching
+	# nodes, with more than two neighbours besides themselves, are dropped
+	# and the rest fall apart into unitigs.
+	consec_pairs = np.asarray(consec_pairs, dtype = np.int64).reshape(-1, 2)
+	print('the total number of edges %d.' %len(consec_pairs))
+	loops = consec_pairs[:, 0] == consec_pairs[:, 1]
+	simple = adjacency.fromEdges(consec_pairs[~loops])
+	branching = simple.nodes[simple.degrees() > 2]
+	keep = loops | ~(np.isin(consec_pairs[:, 0], branching) | np.isin(consec_pairs[:, 1], branching))
+	consec_pairs = consec_pairs[keep]
 
-	unitigs = []
-	hashse = {}
-	for i in start_or_end:
-		hashse[i]=0
+	print('the total number of branching points %d.' %len(branching))
+	print('the total number of good pairs or edges %d.' %len(consec_pairs))
 
-	for i in start_or_end:
-		if hashse[i]==0:
-			unitigs.append([])
-			for j in dfs(nodeToNodess, i):
-				unitigs[-1].append(j)
-				if j in hashse:
-					hashse[j]=1
+	graph = adjacency.fromEdges(consec_pairs)
+	unitigs = graph.walk(graph.ends())
 
 	print('total number of unitigs', len(unitigs))
 	return unitigs
 
-def aux_contigs(unitigs, totalAlnSet):
-	unitigs_ends = {}
-	unitigs_starts = {}
-	unitigs_node_pos = defaultdict(tuple)
-	unitigs_enddict = defaultdict(int)
-	for var in range(len(unitigs)):
-		if len(unitigs[var]) == 1:
-			unitigs_ends[unitigs[var][0]] = unitigs[var][0]
-			unitigs_starts[unitigs[var][0]] = unitigs[var][0]
-			unitigs_enddict[unitigs[var][0]] = 0
-		else:
-		    unitigs_ends[unitigs[var][0]] = unitigs[var][-1]
-		    unitigs_starts[unitigs[var][-1]] = unitigs[var][0]
-		    unitigs_enddict[unitigs[var][0]] = 0
-		    unitigs_enddict[unitigs[var][-1]] = 0
+class unitigIndex(object):
+	# Lookups for the nodes of unitigs, over their sorted ids: the unitig of
+	# nodes[i] and its position in it, whether it is the first or the last
+	# node of the unitig, the node at the other end (for first and last
+	# nodes), and whether the unitig is a single node.
+	def __init__(self, nodes, unitig, pos, first, last, other, single):
+		self.nodes = nodes
+		self.unitig = unitig
+		self.pos = pos
+		self.first = first
+		self.last = last
+		self.other = other
+		self.single = single
 
-		for i in range(len(unitigs[var])):
-			unitigs_node_pos[unitigs[var][i]] = (var, i)
+	@classmethod
+	def build(cls, unitigs):
+		lengths = np.array([len(u) for u in unitigs], dtype = np.int64)
+		ids = np.array([n for u in unitigs for n in u], dtype = np.int64)
+		offsets = getOffsets(lengths)
+		unitig = np.repeat(np.arange(len(unitigs), dtype = np.int64), lengths)
+		pos = np.arange(len(ids), dtype = np.int64) - offsets[unitig]
+		first = pos == 0
+		last = pos == lengths[unitig] - 1
+		other = np.zeros(len(ids), dtype = np.int64)
+		other[first] = ids[offsets[1:][unitig[first]] - 1]
+		other[last] = ids[offsets[:-1][unitig[last]]]
+		order = np.argsort(ids, kind = 'stable')
+		return cls(ids[order], unitig[order], pos[order], first[order], last[order], other[order], (lengths[unitig] == 1)[order])
 
-	aux = aux_unitigs(unitigs)
-	for sample in range(len(totalAlnSet.fullReadList)):
-		for read in totalAlnSet.fullReadList[sample]:
-			unitigDirection = defaultdict(int)
-			new_G = []
-			new_g = []
-			unitig_connection = []
-			lastPos = defaultdict(int) # [unitig index, index in unitig], initially it doesn't mean 'last'
-			for partial in read.partials:
-				for node in partial:
-					if node in unitigs_node_pos:
-						if len(unitigs[unitigs_node_pos[node][0]]) == 1:
-							unitigDirection[unitigs_node_pos[node][0]] = 1
-							continue
-						currentPos = unitigs_node_pos[node]
-						if currentPos[1] > lastPos[currentPos[0]]:
-							unitigDirection[currentPos[0]] = 1 # Forward
-						elif currentPos[1] < lastPos[currentPos[0]]:
-							unitigDirection[currentPos[0]] = -1 # Reverse
-						lastPos[currentPos[0]] = currentPos[1]
-			for partial in read.partials:
-				for node in partial:
-					if node in unitigs_ends.keys() or node in unitigs_starts.keys():
-						unitigIdx = unitigs_node_pos[node][0]
-						direction = unitigDirection[unitigIdx]
-						if unitigs_enddict[node] == 0:
-							if direction == 0:
-								continue
-							else:
-								# Appending Order Matters!
-								if node in unitigs_ends.keys():
-									if direction == 1:
-										new_g.append(node)
-										if unitigs_enddict[unitigs_ends[node]] == 1:
-											new_g.append(unitigs_ends[node])
-											new_gg = new_g.copy()
-											new_G.append(new_gg)
-											new_g = []
-										else:
-											new_g.append(unitigs_ends[node])
-										unitigs_enddict[node] = 1
-										unitigs_enddict[unitigs_ends[node]] = 1
-									elif direction == -1:
-										if unitigs_enddict[unitigs_ends[node]] == 1:
-											new_gg = new_g.copy()
-											new_G.append(new_gg)
-											new_g = []
-										new_g.append(unitigs_ends[node])
-										new_g.append(node)
-										unitigs_enddict[unitigs_ends[node]] = 1
-										unitigs_enddict[node] = 1
-								elif node in unitigs_starts.keys():
-									if direction == 1:
-										if unitigs_enddict[unitigs_starts[node]] == 1:
-											new_gg = new_g.copy()
-											new_G.append(new_gg)
-											new_g = []
-										new_g.append(unitigs_starts[node])
-										new_g.append(node)
-										unitigs_enddict[unitigs_starts[node]] = 1
-										unitigs_enddict[node] = 1
-									elif direction == -1:
-										new_g.append(node)
-										if unitigs_enddict[unitigs_starts[node]] == 1:
-											new_g.append(unitigs_starts[node])
-											new_gg = new_g.copy()
-											new_G.append(new_gg)
-											new_g = []
-										else:
-											new_g.append(unitigs_starts[node])
-										unitigs_enddict[unitigs_starts[node]] = 1
-										unitigs_enddict[node] = 1
-			new_gg = new_g.copy()
-			new_G.append(new_gg)
-			for new_g in new_G:
-				if len(new_g) > 2:
-					aux.addConnection(new_g)
-				for n in new_g:
-					unitigs_enddict[n] = 0
+	def lookup(self, ids):
+		# Index of each node id in nodes, -1 for nodes outside unitigs.
+		if len(self.nodes) == 0:
+			return np.full(len(ids), -1, dtype = np.int64)
+		pos = np.minimum(np.searchsorted(self.nodes, ids), len(self.nodes) - 1)
+		return np.where(self.nodes[pos] == ids, pos, -1)
 
-	AUX = aux.returnConfident()
-	
-	return AUX
+def readConnections(index, nodes, counts):
+	# The unitig ends, in the order they are connected, passed by each read
+	# of a chunk. The reads have counts[i] nodes each, back to back in nodes.
+	# Only groups of more than two ends, i.e. connecting unitigs, are kept.
+	readOf = np.repeat(np.arange(len(counts), dtype = np.int64), counts)
+	idx = index.lookup(nodes)
+	occ = np.flatnonzero(idx >= 0)
+	idx = idx[occ]
+	reads = readOf[occ]
+	# The direction in which a read passes a unitig is given by the last
+	# change of position between consecutive visits of it, starting from
+	# position 0. Single node unitigs are always forward.
+	order = np.lexsort((index.unitig[idx], reads))
+	unitig = index.unitig[idx][order]
+	pos = index.pos[idx][order]
+	sortedReads = reads[order]
+	newGroup = np.ones(len(order), dtype = bool)
+	newGroup[1:] = (sortedReads[1:] != sortedReads[:-1]) | (unitig[1:] != unitig[:-1])
+	prev = np.zeros(len(order), dtype = np.int64)
+	prev[1:] = pos[:-1]
+	prev[newGroup] = 0
+	step = np.sign(pos - prev)
+	step[index.single[idx][order]] = 1
+	group = np.cumsum(newGroup) - 1
+	moved = np.flatnonzero(step)
+	lastMoved = moved[np.r_[group[moved][1:] != group[moved][:-1], True]] if len(moved) else moved
+	groupDirection = np.zeros(len(order), dtype = np.int64)
+	groupDirection[group[lastMoved]] = step[lastMoved]
+	direction = np.empty(len(order), dtype = np.int64)
+	direction[order] = groupDirection[group]
 
-def find_contigs(unitigs, AUX, locus_branch_mapping):
-	consec_pairs_final = defaultdict(set)
+	events = np.flatnonzero((index.first[idx] | index.last[idx]) & (direction != 0))
+	bounds = np.flatnonzero(np.r_[True, reads[events][1:] != reads[events][:-1], True]).tolist() if len(events) else []
+	eventNodes = nodes[occ[events]].tolist()
+	eventOthers = index.other[idx[events]].tolist()
+	eventFirst = index.first[idx[events]].tolist()
+	eventDirection = direction[events].tolist()
+	out = []
+	for b in range(len(bounds) - 1):
+		new_G = []
+		new_g = []
+		connected = set()
+		for e in range(bounds[b], bounds[b + 1]):
+			node = eventNodes[e]
+			if node in connected:
+				continue
+			other = eventOthers[e]
+			split = other in connected
+			# Appending Order Matters!
+			if (eventDirection[e] == 1) == eventFirst[e]:
+				new_g.append(node)
+				new_g.append(other)
+				if split:
+					new_G.append(new_g)
+					new_g = []
+			else:
+				if split:
+					new_G.append(new_g)
+					new_g = []
+				new_g.append(other)
+				new_g.append(node)
+			connected.add(node)
+			connected.add(other)
+		new_G.append(new_g)
+		out.extend(g for g in new_G if len(g) > 2)
+	return out
 
-	count=0   
-	nodeToNodess= defaultdict(set)
-	nodeToNodes = defaultdict(list)
+def readChunks(totalAlnSet, maxNodes = 1 << 20):
+	# Cut the reads of all samples into chunks of about maxNodes nodes.
+	for reads in totalAlnSet.fullReadList:
+		readOffsets = reads.nodeOffsets[reads.partialOffsets]
+		counts = np.diff(readOffsets)
+		cuts = np.searchsorted(readOffsets, np.arange(maxNodes, readOffsets[-1], maxNodes), side = 'right') - 1
+		cuts = uniqueValues(np.r_[0, cuts, len(counts)])
+		for a, b in zip(cuts[:-1].tolist(), cuts[1:].tolist()):
+			yield reads.nodes[readOffsets[a]:readOffsets[b]], counts[a:b]
 
-	for var in AUX:
-		if len(var)>1:
-			for i in range(0,len(var)-1):
-				if var[i] != var[i+1]:
-					nodeToNodess[var[i+1]].add(var[i])
-					nodeToNodess[var[i]].add(var[i+1])
-	for var in unitigs:
-		if len(var) > 1:
-			for i in range(0,len(var)-1):
-				if var[i] != var[i+1]:
-					nodeToNodess[var[i+1]].add(var[i])
-					nodeToNodess[var[i]].add(var[i+1])
-		if len(var) > 2:
-			if var[0] in nodeToNodess[var[len(var)-1]]:
-				nodeToNodess[var[len(var)-1]].remove(var[0])
-			if var[len(var)-1] in nodeToNodess[var[0]]:
-				nodeToNodess[var[0]].remove(var[len(var)-1])
-			
-	for i,j in nodeToNodess.items():
-		nodeToNodes[i] = list(j)
-	bubble1 = []
-	for key, value in nodeToNodes.items():
-		if int(key) < 0:
-			count += 1
-			bubble1.append(key)
+def attachUnitigs(index, unitigs):
+	# Pool initializer: every worker counts the connections of its chunks in
+	# its own aux_unitigs.
+	global workerUnitigs, workerAux
+	workerUnitigs = index
+	workerAux = aux_unitigs(unitigs)
 
-	start_or_end = set()
-	for i,j in nodeToNodes.items():
-		if len(nodeToNodes[i]) ==1:
-			start_or_end.add(i)
-	final_ctgs = []
-	bubbles = []
-	nx_nodeToNodes = nx.MultiDiGraph(nodeToNodes)
+def connectionChunk(chunk):
+	for new_g in readConnections(workerUnitigs, *chunk):
+		workerAux.addConnection(new_g)
+	counts = workerAux.connections
+	workerAux.connections = defaultdict(int)
+	return counts
 
-	hashse = {}
-	for i in start_or_end:
-		hashse[i]=0
+def aux_contigs(unitigs, totalAlnSet, t = 1, minSupport = 5, supportTable = None):
+	# Connections between unitigs seen in the reads, counted by aux_unitigs.
+	# With t > 1 the reads are walked by t processes, whose counts are
+	# merged as they come.
+	index = unitigIndex.build(unitigs)
+	aux = aux_unitigs(unitigs)
+	if t > 1:
+		slots = Semaphore(2 * t)
+		stop = Event()
+		p = Pool(t, initializer = attachUnitigs, initargs = (index, unitigs))
+		try:
+			for counts in p.imap_unordered(connectionChunk, boundedTasks(readChunks(totalAlnSet), slots, stop)):
+				slots.release()
+				aux.mergeCounts(counts)
+			p.close()
+			p.join()
+		except:
+			stop.set()
+			slots.release()
+			p.terminate()
+			raise
+	else:
+		for nodes, counts in readChunks(totalAlnSet):
+			for new_g in readConnections(index, nodes, counts):
+				aux.addConnection(new_g)
 
-	for i in start_or_end:
-		if hashse[i]==0:
-			final_ctgs.append([])
-			for j in dfs(nodeToNodess, i):
-				final_ctgs[-1].append(j)
-				if j in hashse:
-					hashse[j]=1
+	AUX = aux.returnConfident(minSupport, supportTable)
+	
+	return AUX
+
+def find_contigs(unitigs, AUX, locus_branch_mapping, graphFile = None):
+	# Join the unitigs by the confident connections, except the two ends of
+	# a unitig which are not joined directly. With graphFile, the resulting
+	# graph is also written in GraphML for inspection, which needs networkx.
+	edges = []
+	for var in chain(AUX, unitigs):
+		edges.extend((var[i], var[i + 1]) for i in range(len(var) - 1) if var[i] != var[i + 1])
+	closing = set()
+	for var in unitigs:
+		if len(var) > 2:
+			closing.add((var[0], var[-1]))
+			closing.add((var[-1], var[0]))
+	graph = adjacency.fromEdges([e for e in edges if e not in closing])
+	if graphFile:
+		import networkx as nx
+		nx.write_graphml(graph.toNetworkx(), graphFile)
+	final_ctgs = graph.walk(graph.ends())
 	print("Total number of final blocks",len(final_ctgs))
 	fcc = 0
 	final_bubble_number = 0
@@ -247,51 +287,110 @@ def find_contigs(unitigs, AUX, locus_branch_mapping):
 	return useful
 
 
-def group_readset(contig, totalAlnSet, alleles_per_pos, locus_branch_mapping):
+class blockReadset(object):
+	# Reads of one sample in one block. Read i is names[i], with the
+	# variants (positions[k], alleles[k]) for k from offsets[i] to
+	# offsets[i+1], where a position is the 1-based index of the bubble in
+	# the block. Iterating gives [name, (position, allele), ...] lists.
+	def __init__(self, names = None, offsets = None, positions = None, alleles = None):
+		empty = np.zeros(0, dtype = np.int64)
+		self.names = names if names is not None else []
+		self.offsets = offsets if offsets is not None else np.zeros(1, dtype = np.int64)
+		self.positions = positions if positions is not None else empty
+		self.alleles = alleles if alleles is not None else empty
 
-	bc_variants = dict()
-	phaseg_variant = 0
-	alleles_per_pos_BLK = dict()
-	for node in contig:
-		if int(node) < 0:
-			phaseg_variant += 1
-			bc_variants[int(node)] = phaseg_variant
-			alleles_per_pos_BLK[phaseg_variant] = alleles_per_pos[int(node)]
-	readsets = []
-	for sample in range(len(totalAlnSet.bubbleReadMap)):
-		readset_ind = set()
-		for bubble in list(bc_variants.keys()):
-			readset_ind = readset_ind.union(totalAlnSet.bubbleReadMap[sample][bubble])
-		readList_ind = []
-		
-		for read in readset_ind:
-			# Don't partition reads with only one bubbles for now
-			readInfo = [read.name]
-			for var in read.alleles:
-				try:
-					readInfo.append((bc_variants[var[0]], var[1]))
-				except KeyError:
-					pass
-			if len(readInfo) < 3:
-				continue
-			readList_ind.append(readInfo)
-		readsets.append(readList_ind)
+	def __len__(self):
+		return len(self.names)
 
-	return readsets, alleles_per_pos_BLK 
+	def __iter__(self):
+		offsets = self.offsets.tolist()
+		variants = list(zip(self.positions.tolist(), self.alleles.tolist()))
+		for i in range(len(self.names)):
+			yield [self.names[i]] + variants[offsets[i]:offsets[i + 1]]
 
-def bc(locus_file, phase_input_files, t, lowc, highc):
-	print('Input dataset:', locus_file, phase_input_files)
-	totalAlnSet, consec_pairs, alleles_per_pos, locus_branch_mapping = vg_read(locus_file, phase_input_files, t, lowc, highc)
-	unitigs = find_bubble_chains(consec_pairs, locus_branch_mapping)
-	
-	AUX = aux_contigs(unitigs, totalAlnSet)
-	final_ctgs = find_contigs(unitigs, AUX, locus_branch_mapping)
-	total_readsets = []
-	alleles_per_pos_RS = []
-	for contig in final_ctgs:
-		readsets, alleles_per_pos_BLK = group_readset(contig, totalAlnSet, alleles_per_pos, locus_branch_mapping)
-		total_readsets.append(readsets)
-		alleles_per_pos_RS.append(alleles_per_pos_BLK)
+def groupAlleles(reads, bubbles, blocks, positions, nblocks):
+	# Group the alleles of the reads of one sample by block and read,
+	# keeping the groups of at least two alleles. Group i is read
+	# groupReads[i], with the alleles starts[i] to starts[i]+counts[i] of
+	# alleleVars/alleleIdx, and the groups of block b are bounds[b] to
+	# bounds[b+1].
+	loci = reads.alleleLoci
+	readOf = np.repeat(np.arange(len(reads), dtype = np.int64), np.diff(reads.alleleOffsets))
+	hit = np.zeros(len(loci), dtype = bool)
+	pos = np.zeros(0, dtype = np.int64)
+	if len(bubbles) > 0:
+		pos = np.minimum(np.searchsorted(bubbles, loci), len(bubbles) - 1)
+		hit = bubbles[pos] == loci
+		pos = pos[hit]
+	alleleBlocks = blocks[pos]
+	alleleReads = readOf[hit]
+	# Stable, so the alleles of a read keep their order.
+	order = np.lexsort((alleleReads, alleleBlocks))
+	alleleBlocks = alleleBlocks[order]
+	alleleReads = alleleReads[order]
+	alleleVars = positions[pos][order]
+	alleleIdx = reads.alleleIdx[hit][order]
+	starts = np.flatnonzero(np.r_[True, (np.diff(alleleBlocks) != 0) | (np.diff(alleleReads) != 0)])
+	counts = np.diff(np.r_[starts, len(order)])
+	keep = counts >= 2
+	starts, counts = starts[keep], counts[keep]
+	bounds = np.searchsorted(alleleBlocks[starts], np.arange(nblocks + 1)).tolist()
+	return reads.names, alleleReads[starts], starts, counts, bounds, alleleVars, alleleIdx
 
+def group_readsets(final_ctgs, totalAlnSet, alleles_per_pos):
+	# Readsets of all blocks in one pass: every allele of every read is
+	# looked up in one bubble -> (block, position) table, then the alleles
+	# are grouped by block and read. Reads with less than two bubbles in a
+	# block are not partitioned in it for now. Yields the block id, its
+	# readsets (one blockReadset per sample) and alleles per position of
+	# each block in turn, so that only the grouped alleles are held for all
+	# blocks. Blocks come by decreasing reads x bubbles, an estimate of
+	# their phasing time, so that the largest ones are not started last.
+	bubbles, blocks, positions = [], [], []
+	for block, contig in enumerate(final_ctgs):
+		ids = [int(node) for node in contig if int(node) < 0]
+		bubbles.extend(ids)
+		blocks.extend([block] * len(ids))
+		positions.extend(range(1, len(ids) + 1))
+	bubbles = np.array(bubbles, dtype = np.int64)
+	order = np.argsort(bubbles, kind = 'stable')
+	bubbles = bubbles[order]
+	blocks = np.array(blocks, dtype = np.int64)[order]
+	positions = np.array(positions, dtype = np.int64)[order]
+	groups = [groupAlleles(reads, bubbles, blocks, positions, len(final_ctgs)) for reads in totalAlnSet.fullReadList]
+	del totalAlnSet
+	reads = np.zeros(len(final_ctgs), dtype = np.int64)
+	for group in groups:
+		reads += np.diff(group[4])
+	cost = reads * np.bincount(blocks, minlength = len(final_ctgs))
+	for block in np.argsort(-cost, kind = 'stable').tolist():
+		readsets = []
+		for names, groupReads, starts, counts, bounds, alleleVars, alleleIdx in groups:
+			first, last = bounds[block], bounds[block + 1]
+			if first == last:
+				readsets.append(blockReadset())
+				continue
+			offsets = getOffsets(counts[first:last])
+			idx = np.repeat(starts[first:last] - offsets[:-1], counts[first:last]) + np.arange(offsets[-1])
+			readsets.append(blockReadset([names[r] for r in groupReads[first:last].tolist()], offsets, alleleVars[idx], alleleIdx[idx]))
+		ids = [int(node) for node in final_ctgs[block] if int(node) < 0]
+		yield block, readsets, dict((i + 1, alleles_per_pos[b]) for i, b in enumerate(ids))
+
+@contextmanager
+def untimed(stage):
+	yield
 
-	return total_readsets, alleles_per_pos_RS
+def bc(locus_file, phase_input_files, t, lowc, highc, spillDir = None, snarlCache = None, chainGraph = None, minSupport = 5, supportTable = None, timers = untimed):
+	# Returns a generator of the ids, readsets and alleles per position of
+	# the final blocks, see group_readsets. Every step runs in a
+	# "with timers(step)" block, e.g. of a whatshap StageTimer.
+	print('Input dataset:', locus_file, phase_input_files)
+	with timers('vg_read'):
+		totalAlnSet, consec_pairs, alleles_per_pos, locus_branch_mapping = vg_read(locus_file, phase_input_files, t, lowc, highc, spillDir = spillDir, snarlCache = snarlCache)
+	with timers('find_bubble_chains'):
+		unitigs = find_bubble_chains(consec_pairs, locus_branch_mapping)
+	with timers('aux_contigs'):
+		AUX = aux_contigs(unitigs, totalAlnSet, t, minSupport, supportTable)
+	with timers('find_contigs'):
+		final_ctgs = find_contigs(unitigs, AUX, locus_branch_mapping, chainGraph)
+	return group_readsets(final_ctgs, totalAlnSet, alleles_per_pos)
@@ -1,39 +1,62 @@
-from collections import defaultdict
+from array import array
 import sys
-def flt(GFAin, GFAout):
-    degrees = defaultdict(set)
-    allNodes = set()
-    gfa = open(GFAin, 'r').read().split('\n')[:-1]
-    for line in gfa:
-        if line[0] == 'S':
-            allNodes.add(line.split('\t')[1])
-        if line[0] == 'L':
-            tokens = line.split('\t')
-            n1 = tokens[1]
-            n2 = tokens[3]
-            degrees[n1].add(n2)
-            degrees[n2].add(n1)
+def countDegrees(n, pairs):
+    # Number of distinct nodes linked to each of the n nodes, given every
+    # pair of linked node ids once, as n1 << 32 | n2 with n1 <= n2. A node
+    # linked to itself counts once.
+    degrees = array('i', bytes(4 * n))
+    for pair in pairs:
+        n1, n2 = pair >> 32, pair & 0xffffffff
+        degrees[n1] += 1
+        if n2 != n1:
+            degrees[n2] += 1
+    return degrees
 
-    wrong = set()
-    for n in allNodes:
-        if len(degrees[n]) > 70 or len(degrees[n]) == 0:
-            #print(n, len(degrees[n]))
-            wrong.add(n)
-    o = open(GFAout, 'w')
-    for line in gfa:
-        if line[0] == 'S':
-            if line.split('\t')[1] in wrong:
-                continue
-        if line[0] == 'L':
-            tokens = line.split('\t')
-            n1 = tokens[1]
-            n2 = tokens[3]
-            if n1 in wrong or n2 in wrong:
-                continue
-        o.write(line + '\n')
+def wrongNodes(degrees, defined, maxDegree = 70, minDegree = 1):
+    # 1 for the defined nodes linked to more than maxDegree or fewer than
+    # minDegree nodes, 0 for the others.
+    return bytearray(1 if defined[i] and (d > maxDegree or d < minDegree) else 0 for i, d in enumerate(degrees))
+
+def flt(GFAin, GFAout, maxDegree = 70, minDegree = 1):
+    # Remove the segments of GFAin linked to more than maxDegree or fewer
+    # than minDegree distinct segments, with their links. The first pass
+    # interns the names as integer ids and counts the degrees, the second
+    # streams the remaining lines to GFAout.
+    ids = dict()
+    defined = bytearray()
+    pairs = set()
+    def intern(name):
+        i = ids.get(name)
+        if i is None:
+            i = ids[name] = len(ids)
+            defined.append(0)
+        return i
+    with open(GFAin, 'r') as gfa:
+        for line in gfa:
+            if line[0] == 'S':
+                defined[intern(line.split('\t', 2)[1].rstrip('\n'))] = 1
+            if line[0] == 'L':
+                tokens = line.split('\t', 4)
+                n1 = intern(tokens[1])
+                n2 = intern(tokens[3])
+                pairs.add(n1 << 32 | n2 if n1 < n2 else n2 << 32 | n1)
+
+    wrong = wrongNodes(countDegrees(len(ids), pairs), defined, maxDegree, minDegree)
+    del pairs
+
+    with open(GFAin, 'r') as gfa, open(GFAout, 'w') as o:
+        for line in gfa:
+            if line[0] == 'S':
+                if wrong[ids[line.split('\t', 2)[1].rstrip('\n')]]:
+                    continue
+            if line[0] == 'L':
+                tokens = line.split('\t', 4)
+                if wrong[ids[tokens[1]]] or wrong[ids[tokens[3]]]:
+                    continue
+            o.write(line if line.endswith('\n') else line + '\n')
 
 def main():
-    flt(sys.argv[1], sys.argv[2])
+    flt(sys.argv[1], sys.argv[2], *[int(d) for d in sys.argv[3:5]])
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,100 @@
+'''
+Streaming reading and writing of assembly graphs in GFA, to clean up the graph
+of SPAdes before vg resolves its overlaps, and to filter the graph vg writes
+back into the graph the reads are aligned to.
+'''
+import logging
+import numpy as np
+from .filterGraph import countDegrees, wrongNodes
+
+logger = logging.getLogger(__name__)
+orientations = (b'+', b'-')
+
+def canonical(a, oa, b, ob):
+    # A link from a to b and the link from b to a in the flipped
+    # orientations are the same edge of the graph. Keep the form with fewer
+    # reverse orientations, and then the one starting at the smaller id, as
+    # one integer holding both ids and whether each is reversed.
+    ra, rb = oa == b'-', ob == b'-'
+    if (ra + rb, a) <= (2 - ra - rb, b):
+        return (a << 32 | b) << 2 | ra << 1 | rb
+    return (b << 32 | a) << 2 | (not rb) << 1 | (not ra)
+
+def unpack(links):
+    # The ids of the segments of links returned by canonical, and whether each
+    # of them is reversed.
+    links = np.asarray(links, dtype = np.int64)
+    return links >> 34, links >> 2 & 0xffffffff, links >> 1 & 1, links & 1
+
+def readGfa(path):
+    # Scan the GFA at path once. Segment names are interned as integer ids in
+    # the order they are first seen. Returns the names, the offsets of the
+    # segment lines in the file, -1 for names only seen in links, and the
+    # links between distinct segments as returned by canonical, each once, mapped to
+    # their overlap. Path lines and self-loops are dropped, and the sequences
+    # are left in the file.
+    ids = dict()
+    names = []
+    offsets = []
+    links = dict()
+    overlaps = dict()
+    def intern(name):
+        i = ids.get(name)
+        if i is None:
+            i = ids[name] = len(names)
+            names.append(name)
+            offsets.append(-1)
+        return i
+    offset = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'S\t'):
+                offsets[intern(line.split(b'\t', 2)[1].rstrip(b'\r\n'))] = offset
+            elif line.startswith(b'L\t'):
+                tokens = line.rstrip(b'\r\n').split(b'\t')
+                if tokens[1] != tokens[3]:
+                    link = canonical(intern(tokens[1]), tokens[2], intern(tokens[3]), tokens[4])
+                    overlap = tokens[5] if len(tokens) > 5 else b'0M'
+                    links.setdefault(link, overlaps.setdefault(overlap, overlap))
+            offset += len(line)
+    return names, np.array(offsets, dtype = np.int64), links
+
+def prepare(GFAin, GFAout, maxDegree = 70, minDegree = 1):
+    # Write the graph in GFAin to GFAout in the layout of vg view -g: a
+    # header, the segments with their name and sequence only, then every
+    # link once, without paths and self-loops. The overlaps of the links are
+    # copied from GFAin, 0M where missing, they are not resolved here.
+    # Segments linked to more than maxDegree or fewer than minDegree other
+    # segments are removed with their links, as filterGraph.flt does,
+    # unless maxDegree is None.
+    names, offsets, links = readGfa(GFAin)
+    defined = offsets >= 0
+    keep = defined
+    if maxDegree is not None:
+        a, b = unpack(list(links))[:2]
+        linked = defined[a] & defined[b]
+        pairs = np.unique(np.minimum(a, b)[linked] << 32 | np.maximum(a, b)[linked])
+        wrong = wrongNodes(countDegrees(len(names), pairs.tolist()), defined.tolist(), maxDegree, minDegree)
+        keep = defined & (np.frombuffer(wrong, dtype = np.uint8) == 0)
+    missing = np.count_nonzero(offsets < 0)
+    if missing:
+        logger.warning('%d segments of %s are linked to but never defined, their links are removed.' % (missing, GFAin))
+    kept = np.flatnonzero(keep)
+    kept = kept[np.argsort(offsets[kept], kind = 'stable')]
+    nlinks = 0
+    with open(GFAin, 'rb') as f, open(GFAout, 'wb') as o:
+        o.write(b'H\tVN:Z:1.0\n')
+        for i in kept:
+            f.seek(offsets[i])
+            tokens = f.readline().rstrip(b'\r\n').split(b'\t', 3)
+            o.write(b'\t'.join(tokens[:3]) + b'\n')
+        for link in sorted(links):
+            a, b = link >> 34, link >> 2 & 0xffffffff
+            if keep[a] and keep[b]:
+                o.write(b'\t'.join((b'L', names[a], orientations[link >> 1 & 1], names[b], orientations[link & 1], links[link])) + b'\n')
+                nlinks += 1
+    if maxDegree is None:
+        logger.info('%d segments and %d links kept.' % (len(kept), nlinks))
+    else:
+        logger.info('%d of %d segments and %d of %d links kept, removed %d segments linked to more than %d or fewer than %d others.'
+                    % (len(kept), len(names) - missing, nlinks, len(links), len(names) - missing - len(kept), maxDegree, minDegree))
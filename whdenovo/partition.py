@@ -8,7 +8,8 @@ from subprocess import PIPE
 import os, sys, time
 import logging
 import re
-from . import filterGraph
+from . import gfa
+from . import pipeline
 
 def checkStatus(args):
     if sys.version_info.major != 3:
@@ -52,66 +53,88 @@ def run_pipeline(args):
     if not os.path.isdir(tempPath):
         subprocess.call(['mkdir', tempPath])
         subprocess.call(['mkdir', '%s/illumina'%tempPath])
-        subprocess.call(['mkdir', '%s/bc1'%tempPath])
-    else:
-        logging.error('Output directory %s already exits' % tempPath)
+    elif not args.resume:
+        logging.error('Output directory %s already exits, use --resume to continue a run in it' % tempPath)
         sys.exit(1)
+    else:
+        logging.info('Resuming the run in %s' % tempPath)
 
-    # spades  ADDED "-m 500" FOR LARGE GENOME
-    logging.info('bfc error correcting...')
-    subprocess.call('bfc -t %d -s %s %s 1> %s/cor.1.fq 2>> %s/bfc.log'%(args.t, args.size, args.illumina1, tempPath, tempPath), shell = True)
-    subprocess.call('bfc -t %d -s %s %s 1> %s/cor.2.fq 2>> %s/bfc.log'%(args.t, args.size, args.illumina2, tempPath, tempPath), shell = True)
-    logging.info('bfc log saved at %s/bfc.log'%tempPath)
-     
-    logging.info('Running spades...')
-    spades_cmd = "spades.py -t %d -k %d -m 500 -1 %s/cor.1.fq -2 %s/cor.2.fq --only-assembler -o %s/illumina/" % (args.t, args.k, tempPath, tempPath, tempPath)
-    spades_cmd = spades_cmd.split()
-    a = subprocess.call(spades_cmd, shell=False, stdout=subprocess.PIPE)
-    if a != 0:
-        logging.error('Error while running spades. Error Code: %d'%a)
-        sys.exit(1)
+    stages = make_stages(args, tempPath, whdenovoPath, vg, graphaligner)
+    start = time.time()
+    code = pipeline.runStages(stages, '%s/stages' % tempPath, args.resume, args.t)
+    pipeline.writeReport(stages, '%s/stages' % tempPath, '%s/report.json' % tempPath, time.time() - start,
+                         {'phaseg': '%s/phaseg.report.json' % tempPath})
+    logging.info('Time and resources used by each stage saved at %s/report.json' % tempPath)
+    if code != 0:
+        logging.error('Rerun with --resume -o %s to continue from the failed stage.' % args.output if args.output else 'Stopped.')
+        sys.exit(code if code > 0 else 1)
+    logging.info('bfc logs saved at %s/bfc.1.log and %s/bfc.2.log'%(tempPath, tempPath))
     logging.info('SPAdes log saved at %s/illumina/spades.log'%tempPath)
-
-    logging.info('Filtering graph...')
-    subprocess.call("grep -v '^P' %s/illumina/assembly_graph_with_scaffolds.gfa | awk -F'\\t' '{ if ($2 != $4) print $0}' | %s view --gfa-in - --vg | %s view -g - | awk -F'\\t' '{ if ($2 !=$4) print $0}' > %s/asm1.gfa" % (tempPath , vg, vg, tempPath), shell = True)
-    filterGraph.flt('%s/asm1.gfa'%tempPath, '%s/illumina/asm1.gfa'%tempPath)
-    #subprocess.call("python2 %s/whdenovo/printnodedegrees_gfa.py %s/asm1.gfa | awk -F' ' '{ if($2 > 70 || $2==0) printf \"%%s\\n\", $1 }' > %s/asm1.wrongnodes"%(whdenovoPath, tempPath, tempPath), shell = True)
-    #subprocess.call('python2 %s/whdenovo/remove_wrongnodes.py %s/asm1.wrongnodes %s/asm1.gfa %s/illumina/asm1.gfa'%(whdenovoPath, tempPath, tempPath, tempPath), shell = True)
-    logging.info('Running snarls...')
-    subprocess.call('%s view --gfa-in --vg %s/illumina/asm1.gfa > %s/illumina/asm1.vg' % (vg, tempPath, tempPath), shell = True)
-    subprocess.call('%s snarls -t -r %s/illumina/asm1.trans %s/illumina/asm1.vg > %s/illumina/asm1.snarls' % (vg, tempPath, tempPath, tempPath), shell = True)
-
-    logging.info('Aligning...')
-    if args.ped != None:
-        for i in range(3):
-            a = subprocess.call("%s -t %d -g %s/illumina/asm1.gfa -f %s -a %s/aln%d.gam --seeds-mum-count 100000 --seeds-mxm-length 10 -C 500000 -b 35" % (graphaligner, args.t, tempPath, args.pacbio[i], tempPath, i), shell = True, stdout=subprocess.PIPE)
-            if a != 0:
-                logging.error('Error while running GraphAligner. Exit Code:%d'%a)
-                sys.exit(2)
-    elif args.ped == None:
-        a = subprocess.call("%s -t %d -g %s/illumina/asm1.gfa -f %s -a %s/aln.gam --seeds-mum-count 100000 --seeds-mxm-length 10 -C 500000 -b 35" % (graphaligner, args.t, tempPath, args.pacbio[0], tempPath), shell = True, stdout=subprocess.PIPE)
-        if a != 0:
-            logging.error('Error while running GraphAligner. Exit Code: %d'%a)
-            sys.exit(a) 
-    a = subprocess.call("ls %s/aln*gam | parallel '%s view -a {} > {}.json'"%(tempPath, vg), shell = True)
-    if a != 0:
-        logging.error('Error while converting GAM to JSON. Exit Code: %d'%a)
-        sys.exit(a)
-
-    logging.info('Partitioning...')
     if args.ped != None:
-        subprocess.call("whatshap_tri phaseg reads %s %s/illumina/asm1.trans %s/aln0.gam.json %s/aln1.gam.json %s/aln2.gam.json -t %d -p %s/bc1/aln --lowc %d --high %d > %s/partition.log" % (whdenovoPath, args.ped, tempPath, tempPath, tempPath, tempPath, args.t, tempPath, args.lowc, args.highc, tempPath), shell = True)
-        subprocess.call("ls %s/bc1/*allreads | parallel -j%d \"awk '\\$3 == 1 {print \\$1}' {} > {}.hp1.reads\"" % (tempPath, args.t), shell = True)
-        subprocess.call("ls %s/bc1/*allreads | parallel -j%d \"awk '\\$3 == 0 {print \\$1}' {} > {}.hp0.reads\"" % (tempPath, args.t), shell = True)
-        subprocess.call("cat %s/bc1/*hp1.reads | sort | uniq > %s/HP1.reads" % (tempPath,tempPath), shell = True)
-        subprocess.call("cat %s/bc1/*hp0.reads | sort | uniq > %s/HP0.reads" % (tempPath,tempPath), shell = True)
         logging.info('Partitioning finished. Read names of different haplotypes are saved in:')
         print('%s/HP0.reads'%tempPath)
         print('%s/HP1.reads'%tempPath)
+        logging.info('Partitioning of the reads in every block is saved in %s/partition.tsv.gz'%tempPath)
     else:
         # TODO individual case
         pass
-        
+
+def make_stages(args, tempPath, whdenovoPath, vg, graphaligner):
+    # The pipeline as pipeline.stage objects. Each stage lists the files it
+    # reads and writes, which order the stages and which --resume checks.
+    # The two bfc runs and the alignments of the samples are independent,
+    # so they share the -t threads and run at the same time.
+    stages = []
+    stage = pipeline.stage
+    bfcThreads = split_threads(args.t, 2)
+    for i, reads in enumerate([args.illumina1, args.illumina2]):
+        stages.append(stage('bfc%d' % (i + 1), 'bfc error correcting...',
+                            'bfc -t %d -s %s %s 1> %s/cor.%d.fq 2> %s/bfc.%d.log'%(bfcThreads[i], args.size, reads, tempPath, i + 1, tempPath, i + 1),
+                            [reads], ['%s/cor.%d.fq'%(tempPath, i + 1)], threads = bfcThreads[i]))
+    # spades  ADDED "-m 500" FOR LARGE GENOME
+    stages.append(stage('spades', 'Running spades...',
+                        "spades.py -t %d -k %d -m 500 -1 %s/cor.1.fq -2 %s/cor.2.fq --only-assembler -o %s/illumina/" % (args.t, args.k, tempPath, tempPath, tempPath),
+                        ['%s/cor.1.fq'%tempPath, '%s/cor.2.fq'%tempPath], ['%s/illumina/assembly_graph_with_scaffolds.gfa'%tempPath], quiet = True, threads = args.t))
+    # The links of SPAdes overlap by k-1 bases. vg resolves the overlaps
+    # when it reads the cleaned graph, and the graph it writes back is the
+    # one the degree filter, GraphAligner and vg snarls all work on, so
+    # that node ids and sequences agree between the alignments and snarls.
+    stages.append(stage('gfa', 'Cleaning graph...', gfa.prepare,
+                        ['%s/illumina/assembly_graph_with_scaffolds.gfa'%tempPath], ['%s/illumina/asm0.gfa'%tempPath],
+                        args = ('%s/illumina/assembly_graph_with_scaffolds.gfa'%tempPath, '%s/illumina/asm0.gfa'%tempPath, None)))
+    stages.append(stage('overlaps', 'Resolving overlaps with vg...',
+                        '%s view --gfa-in --vg %s/illumina/asm0.gfa > %s/illumina/asm0.vg && %s view -g %s/illumina/asm0.vg > %s/illumina/asm0.vg.gfa' % (vg, tempPath, tempPath, vg, tempPath, tempPath),
+                        ['%s/illumina/asm0.gfa'%tempPath], ['%s/illumina/asm0.vg'%tempPath, '%s/illumina/asm0.vg.gfa'%tempPath]))
+    stages.append(stage('filter', 'Filtering graph...', gfa.prepare,
+                        ['%s/illumina/asm0.vg.gfa'%tempPath], ['%s/illumina/asm1.gfa'%tempPath],
+                        args = ('%s/illumina/asm0.vg.gfa'%tempPath, '%s/illumina/asm1.gfa'%tempPath, args.max_degree, args.min_degree)))
+    stages.append(stage('vg', 'Converting the graph to vg...',
+                        '%s view --gfa-in --vg %s/illumina/asm1.gfa > %s/illumina/asm1.vg' % (vg, tempPath, tempPath),
+                        ['%s/illumina/asm1.gfa'%tempPath], ['%s/illumina/asm1.vg'%tempPath]))
+    stages.append(stage('snarls', 'Running snarls...',
+                        '%s snarls -t -r %s/illumina/asm1.trans %s/illumina/asm1.vg > %s/illumina/asm1.snarls' % (vg, tempPath, tempPath, tempPath),
+                        ['%s/illumina/asm1.vg'%tempPath], ['%s/illumina/asm1.trans'%tempPath, '%s/illumina/asm1.snarls'%tempPath]))
+    if args.ped != None:
+        gams = ['%s/aln%d.gam' % (tempPath, i) for i in range(3)]
+    else:
+        gams = ['%s/aln.gam' % tempPath]
+    alignThreads = split_threads(args.t, len(gams))
+    for i in range(len(gams)):
+        stages.append(stage('align%d' % i if len(gams) > 1 else 'align', 'Aligning...',
+                            "%s -t %d -g %s/illumina/asm1.gfa -f %s -a %s --seeds-mum-count 100000 --seeds-mxm-length 10 -C 500000 -b 35" % (graphaligner, alignThreads[i], tempPath, args.pacbio[i], gams[i]),
+                            ['%s/illumina/asm1.gfa'%tempPath, args.pacbio[i]], [gams[i]], quiet = True, threads = alignThreads[i]))
+    if args.ped != None:
+        spill = ' --spill-dir %s/spill' % tempPath if args.spill else ''
+        stages.append(stage('phaseg', 'Partitioning...',
+                            "whatshap_tri phaseg reads %s %s/illumina/asm1.trans %s/aln0.gam %s/aln1.gam %s/aln2.gam -t %d --partition-table %s/partition.tsv.gz --haplotype-reads %s/HP0.reads %s/HP1.reads --report %s/phaseg.report.json --snarl-cache %s/snarlcache --lowc %d --high %d%s > %s/partition.log" % (args.ped, tempPath, tempPath, tempPath, tempPath, args.t, tempPath, tempPath, tempPath, tempPath, tempPath, args.lowc, args.highc, spill, tempPath),
+                            [args.ped, '%s/illumina/asm1.trans'%tempPath] + gams,
+                            ['%s/partition.tsv.gz'%tempPath, '%s/HP0.reads'%tempPath, '%s/HP1.reads'%tempPath, '%s/phaseg.report.json'%tempPath], threads = args.t))
+    return stages
+
+def split_threads(t, n):
+    # Share t threads between n stages running together, at least one each.
+    return [max(1, t // n + (1 if i < t % n else 0)) for i in range(n)]
+
 def run_test(sth):
     print(sth)
 
@@ -132,9 +155,13 @@ def add_arguments(parser):
                         required = False)
     arg('-k', type = int, default = 77 , help = 'K-mer size setting for SPAdes, must be odd and no larger than 128. [77].')
     arg('-s', '--size', type = str, required = True, help = 'Expected genome size, acceptible example: 50k, 24m, 2g.')
-    arg('-t', metavar = 'INT', type = int, default = 4, help = "Use multiprocessing in the algorithm, and some steps utilize GNU parallel. [4]")
+    arg('-t', metavar = 'INT', type = int, default = 4, help = "Use multiprocessing in the algorithm. [4]")
     arg('--lowc', metavar = 'INT', type = int, default = 5, help = 'Lowest threshold for coverage to support edges.')
     arg('--highc', metavar = 'INT', type = int, default = 20, help = 'Highest threshold for coverage to detect repeats.')
+    arg('--max-degree', metavar = 'INT', type = int, default = 70, help = 'Remove the nodes of the assembly graph linked to more other nodes. [70]')
+    arg('--min-degree', metavar = 'INT', type = int, default = 1, help = 'Remove the nodes of the assembly graph linked to fewer other nodes. [1]')
+    arg('--resume', action = 'store_true', help = 'Continue an interrupted run in the output directory given with -o, skipping the stages that completed and whose input files did not change since.')
+    arg('--spill', action = 'store_true', help = 'Spill sorted alignment runs to the output directory while partitioning, for inputs that do not fit in memory.')
 
 def main(args):
     checkStatus(args)
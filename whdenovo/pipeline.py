@@ -0,0 +1,234 @@
+'''
+Stages of the partition pipeline, with completion markers so that an
+interrupted run can be resumed, and a report of the resources used by each.
+'''
+import os, time
+import json
+import hashlib
+import logging
+import resource
+import subprocess
+import threading
+import queue
+
+def fileDigest(path, known = None):
+    # Size, modification time and sha1 of the file at path. When known is
+    # an earlier digest of the same path with equal size and modification
+    # time, its sha1 is reused instead of reading the file again.
+    st = os.stat(path)
+    if known is not None and known.get('size') == st.st_size and known.get('mtime') == st.st_mtime_ns:
+        return dict(known)
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha1': h.hexdigest()}
+
+class stage(object):
+    # One step of the pipeline, reading the files inputs and writing the
+    # files outputs. cmd is either a shell command, or a python function
+    # called with args. A stage runs after the stages writing its inputs,
+    # and takes threads of the CPUs given to runStages.
+    def __init__(self, name, message, cmd, inputs, outputs, args = (), quiet = False, threads = 1):
+        self.name = name
+        self.message = message
+        self.cmd = cmd
+        self.args = tuple(args)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.quiet = quiet
+        self.threads = threads
+
+    def command(self):
+        # What the stage runs, as recorded in its marker.
+        if callable(self.cmd):
+            return '%s.%s%r' % (self.cmd.__module__, self.cmd.__name__, self.args)
+        return self.cmd
+
+    def run(self):
+        # Returns the exit code, the CPU seconds and the peak RSS in kB. A
+        # command is waited for with wait4, which gives the usage of its
+        # own processes even when other stages run at the same time. For a
+        # python function, the usage of the whole process is taken.
+        if callable(self.cmd):
+            before = cpuTime(resource.getrusage(resource.RUSAGE_SELF))
+            self.cmd(*self.args)
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            return 0, cpuTime(usage) - before, usage.ru_maxrss
+        p = subprocess.Popen(self.cmd, shell = True, stdout = subprocess.DEVNULL if self.quiet else None)
+        pid, status, usage = os.wait4(p.pid, 0)
+        p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        return p.returncode, cpuTime(usage), usage.ru_maxrss
+
+def cpuTime(usage):
+    return usage.ru_utime + usage.ru_stime
+
+def markerPath(markerDir, s):
+    return os.path.join(markerDir, s.name + '.json')
+
+def readMarker(markerDir, s):
+    try:
+        with open(markerPath(markerDir, s)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def writeMarker(markerDir, s, marker):
+    # Write to a temporary file first, so that an interrupted write never
+    # leaves a marker behind.
+    path = markerPath(markerDir, s)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(marker, f, indent = 1)
+    os.replace(path + '.tmp', path)
+
+def isComplete(markerDir, s):
+    # A stage is complete if its marker records a successful run of the
+    # same command on inputs with the same content, and its outputs are
+    # still those it wrote.
+    marker = readMarker(markerDir, s)
+    if marker is None or marker.get('exit') != 0 or marker.get('command') != s.command():
+        return False
+    for key, paths in (('inputs', s.inputs), ('outputs', s.outputs)):
+        recorded = marker.get(key, {})
+        if sorted(recorded) != sorted(paths):
+            return False
+        for path in paths:
+            if not os.path.exists(path):
+                return False
+            if fileDigest(path, recorded[path])['sha1'] != recorded[path]['sha1']:
+                return False
+    return True
+
+def dependencies(stages):
+    # Names of the earlier stages writing the inputs of each stage.
+    writers = dict()
+    after = dict()
+    for s in stages:
+        after[s.name] = sorted(set(writers[path] for path in s.inputs if path in writers))
+        for path in s.outputs:
+            writers[path] = s.name
+    return after
+
+def printPlan(stages, after, threads):
+    logging.info('Stage plan with %d threads:' % threads)
+    for s in stages:
+        logging.info('  %-8s %3d threads%s' % (s.name, s.threads, '  after ' + ' '.join(after[s.name]) if after[s.name] else ''))
+
+def runStage(markerDir, s):
+    # Run one stage and write its marker. Returns the exit code, 1 if
+    # anything fails, including the checksums or the marker.
+    logging.info('%s (%s)' % (s.message, s.name))
+    marker = {'name': s.name, 'command': s.command(), 'cpu_seconds': 0, 'max_rss_kb': 0}
+    start = time.time()
+    try:
+        marker['inputs'] = dict((path, fileDigest(path)) for path in s.inputs)
+        code, marker['cpu_seconds'], marker['max_rss_kb'] = s.run()
+        marker['seconds'] = time.time() - start
+        marker['exit'] = code
+        missing = [path for path in s.outputs if not os.path.exists(path)]
+        if code == 0 and missing:
+            logging.error('%s did not write %s' % (s.name, ' '.join(missing)))
+            marker['exit'] = code = 1
+        if code == 0:
+            marker['outputs'] = dict((path, fileDigest(path)) for path in s.outputs)
+        writeMarker(markerDir, s, marker)
+    except Exception:
+        logging.exception('Error while running %s.' % s.name)
+        code = 1
+        marker['seconds'] = time.time() - start
+        marker['exit'] = code
+        marker.pop('outputs', None)
+        try:
+            writeMarker(markerDir, s, marker)
+        except Exception:
+            pass
+    if code != 0:
+        logging.error('Error while running %s. Exit code: %d' % (s.name, code))
+    else:
+        logging.info('%s done in %.1fs' % (s.name, marker['seconds']))
+    return code
+
+def postStage(markerDir, s, finished):
+    # Thread target of runStages, which waits for every stage it started:
+    # the outcome is always posted, 1 unless runStage returned.
+    code = 1
+    try:
+        code = runStage(markerDir, s)
+    finally:
+        finished.put((s.name, code))
+
+def runStages(stages, markerDir, resume = False, threads = 1):
+    # Run the stages, each as soon as the stages writing its inputs are done
+    # and enough of the threads are free. A stage needing more threads than
+    # are given runs alone. With resume, complete stages are skipped. A
+    # stage whose inputs were rewritten with a different content by an
+    # earlier stage is run again. After a failing stage no other stage is
+    # started, the running ones are waited for, and the exit code of the
+    # first failing stage is returned, or 0.
+    if not os.path.isdir(markerDir):
+        os.makedirs(markerDir)
+    after = dependencies(stages)
+    printPlan(stages, after, threads)
+    pending = list(stages)
+    done = set()
+    checked = set()
+    running = dict()
+    finished = queue.Queue()
+    free = threads
+    code = 0
+    while True:
+        started = True
+        while started and code == 0:
+            started = False
+            for s in list(pending):
+                if not all(name in done for name in after[s.name]):
+                    continue
+                if resume and s.name not in checked:
+                    checked.add(s.name)
+                    if isComplete(markerDir, s):
+                        logging.info('Skipping %s, already done.' % s.name)
+                        pending.remove(s)
+                        done.add(s.name)
+                        started = True
+                        continue
+                if running and s.threads > free:
+                    continue
+                pending.remove(s)
+                running[s.name] = s
+                free -= s.threads
+                worker = threading.Thread(target = postStage, args = (markerDir, s, finished))
+                worker.daemon = True
+                worker.start()
+                started = True
+        if not running:
+            break
+        name, stageCode = finished.get()
+        free += running.pop(name).threads
+        if stageCode == 0:
+            done.add(name)
+        elif code == 0:
+            code = stageCode
+    return code
+
+def writeReport(stages, markerDir, path, seconds, steps = None):
+    # Write the wall and CPU time, peak RSS, exit code and input and output
+    # sizes of every stage, as recorded in their markers, and the wall time
+    # seconds of the whole run to path as JSON. A stage skipped by --resume
+    # is reported as it was in the run that did it. steps maps stage names
+    # to JSON reports of their own steps, included when the files exist.
+    report = {'seconds': seconds, 'stages': []}
+    for s in stages:
+        entry = {'name': s.name, 'threads': s.threads}
+        marker = readMarker(markerDir, s)
+        if marker is not None:
+            for key in ('seconds', 'cpu_seconds', 'max_rss_kb', 'exit'):
+                entry[key] = marker.get(key)
+            for key in ('inputs', 'outputs'):
+                entry[key] = dict((p, d['size']) for p, d in marker.get(key, {}).items())
+            if steps and s.name in steps and os.path.exists(steps[s.name]):
+                with open(steps[s.name]) as f:
+                    entry['steps'] = json.load(f)
+        report['stages'].append(entry)
+    report['cpu_seconds'] = sum(e.get('cpu_seconds', 0) for e in report['stages'])
+    with open(path, 'w') as f:
+        json.dump(report, f, indent = 1)
@@ -1,4 +1,8 @@
 from collections import defaultdict
+import heapq
+import logging
+
+logger = logging.getLogger(__name__)
 
 class aux_unitigs():
 	# a module for filtering the unitig connections
@@ -12,8 +16,9 @@ class aux_unitigs():
 			self.endMap[unitigs[u][0]] = u
 			self.unitigStart[unitigs[u][-1]] = unitigs[u][0]
 			self.unitigEnd[unitigs[u][0]] = unitigs[u][-1]
+		# Support of each connection, under its canonical form (see
+		# canonConn), so that counts of separate instances can be merged.
 		self.connections = defaultdict(int)
-		self.pair = defaultdict(set)
 	def addConnection(self, new_g):
 		# add connections detected from reads. Merge equivalent 
 		# connections together
@@ -25,81 +30,93 @@ class aux_unitigs():
 			if node in self.unitigEnd:
 				connections.append((self.endMap[node], 1))
 		for i in range(len(connections) - 1):
-			u1 = connections[i]
-			u2 = connections[i + 1]
-			if (u1[0], u2[0]) in self.pair:
-				if (u1, u2) in self.connections:
-					self.connections[(u1, u2)] += 1
-				elif equivConn((u1, u2)) in self.connections:
-					self.connections[equivConn((u1, u2))] += 1
-				else:
-					self.connections[(u1, u2)] = 1
-					self.pair[u1[0], u2[0]].add((u1, u2))
-			elif (u2[0], u1[0]) in self.pair:
-				if (u1, u2) in self.connections:
-					self.connections[(u1, u2)] += 1
-				elif equivConn((u1, u2)) in self.connections:
-					self.connections[equivConn((u1, u2))] += 1
-				else:
-					self.connections[(u1, u2)] = 1
-					self.pair[(u2[0], u1[0])].add((u1, u2))
-			else:
-				self.pair[(u1[0], u2[0])].add((u1, u2))
-				self.connections[(u1, u2)] += 1
+			self.connections[canonConn((connections[i], connections[i + 1]))] += 1
+
+	def mergeCounts(self, connections):
+		# Add the connection counts of another instance over the same
+		# unitigs, e.g. one filled by a worker process.
+		for connection, n in connections.items():
+			self.connections[connection] += n
 
-	def returnConfident(self):
+	def returnConfident(self, minSupport = 5, supportTable = None):
 		# First pick the most prevalent type of connection between 
-		# two specific unitigs. Then sort all connections by number 
-		# of supporting reads and pick from top, allowing only one 
-		# connection for one unitig end.
-		allout = []
-		for pair, connections in self.pair.items():
-			out = (0, ())
-			for connection in connections:
-				if self.connections[connection] > out[0]:
-					out = (self.connections[connection], connection)
-			allout.append(out)
-		allout = sorted(allout)[::-1]
+		# two specific unitigs. Then take the connections by number 
+		# of supporting reads from top, allowing only one 
+		# connection for one unitig end. Connections with less than
+		# minSupport reads are never taken. With supportTable, the support
+		# of all connections is written to this file as TSV.
+		# Ties in support, between the connections of one pair of unitigs
+		# as well as between pairs, go to the larger canonical connection,
+		# so the result does not depend on the order reads were counted in.
+		# This is an intended change: the choice within a pair used to
+		# follow the iteration order of a set.
+		best = dict()
+		for connection, n in self.connections.items():
+			pair = tuple(sorted((connection[0][0], connection[1][0])))
+			if pair not in best or (n, connection) > best[pair]:
+				best[pair] = (n, connection)
+		# Pop candidates from a heap by decreasing (n, connection), so that
+		# only as many are ordered as needed to use up the unitig ends.
+		heap = [((-n, tuple((-u, -d) for u, d in connection)), n, connection) for n, connection in best.values() if n >= minSupport]
+		heapq.heapify(heap)
+		candidates = len(heap)
 		AUX = []
+		accepted = set()
 		connected = set()
-		for connection in allout:
-			# connection = (n, (uid1, dir1), (uid2, dir2))
-			# n is the frequency of this type of connection. 
+		while heap and len(connected) < 4 * len(self.unitigs):
+			key, n, connection = heapq.heappop(heap)
+			# connection = ((uid1, dir1), (uid2, dir2)), supported by n reads
 			new_g = []
-			if connection[0] < 5:
-				continue
-			SE1 = (connection[1][0][0], connection[1][0][1], 0)
+			SE1 = (connection[0][0], connection[0][1], 0)
 			eSE1 = equivStickyEnd(SE1)
-			SE2 = (connection[1][1][0], connection[1][1][1], 1)
+			SE2 = (connection[1][0], connection[1][1], 1)
 			eSE2 = equivStickyEnd(SE2)
 			if SE1 in connected or eSE1 in connected or SE2 in connected or eSE2 in connected:
-				#if connected[connection[1][0][0]] == 2 or connected[connection[1][1][0]] == 2:
 				continue
-			print(connection)
-			connected.add(SE1)
-			connected.add(SE2)
-			#connected[connection[1][0][0]] += 1
-			#connected[connection[1][1][0]] += 1
-			if connection[1][0][1] == 1:
-				new_g.append(self.unitigs[connection[1][0][0]][0])
-				new_g.append(self.unitigs[connection[1][0][0]][-1])
+			logger.debug('Connecting unitigs %s with %d supporting reads', connection, n)
+			accepted.add(connection)
+			for end in (SE1, eSE1, SE2, eSE2):
+				connected.add(end)
+			if connection[0][1] == 1:
+				new_g.append(self.unitigs[connection[0][0]][0])
+				new_g.append(self.unitigs[connection[0][0]][-1])
 			else:
-				new_g.append(self.unitigs[connection[1][0][0]][-1])
-				new_g.append(self.unitigs[connection[1][0][0]][0])
-			if connection[1][1][1] == 1:
-				new_g.append(self.unitigs[connection[1][1][0]][0])
-				new_g.append(self.unitigs[connection[1][1][0]][-1])
+				new_g.append(self.unitigs[connection[0][0]][-1])
+				new_g.append(self.unitigs[connection[0][0]][0])
+			if connection[1][1] == 1:
+				new_g.append(self.unitigs[connection[1][0]][0])
+				new_g.append(self.unitigs[connection[1][0]][-1])
 			else:
-				new_g.append(self.unitigs[connection[1][1][0]][-1])
-				new_g.append(self.unitigs[connection[1][1][0]][0])
+				new_g.append(self.unitigs[connection[1][0]][-1])
+				new_g.append(self.unitigs[connection[1][0]][0])
 			AUX.append(new_g)
+		logger.info('%d unitig connections between %d pairs of unitigs, %d pairs with at least %d supporting reads, %d connections taken',
+		            len(self.connections), len(best), candidates, minSupport, len(AUX))
+		if supportTable:
+			self.writeSupport(supportTable, set(c for n, c in best.values()), accepted)
 		return AUX
 
+	def writeSupport(self, path, best, accepted):
+		# One line per connection, by decreasing support. best tells if it is
+		# the most supported connection of its pair of unitigs, accepted if
+		# it was taken.
+		with open(path, 'w') as f:
+			print('unitig1', 'first1', 'last1', 'direction1', 'unitig2', 'first2', 'last2', 'direction2', 'support', 'best', 'accepted', sep = '\t', file = f)
+			for connection, n in sorted(self.connections.items(), key = lambda c: (-c[1], c[0])):
+				(u1, d1), (u2, d2) = connection
+				print(u1, self.unitigs[u1][0], self.unitigs[u1][-1], d1, u2, self.unitigs[u2][0], self.unitigs[u2][-1], d2, n,
+				      int(connection in best), int(connection in accepted), sep = '\t', file = f)
+
 def equivConn(connection):
 	u1 = connection[0]
 	u2 = connection[1]
 	return ((u2[0], -1 * u2[1]), (u1[0], -1 * u1[1]))
 
+def canonConn(connection):
+	# The smaller of a connection and its equivalent, so that both count
+	# towards the same key.
+	return min(connection, equivConn(connection))
+
 def equivStickyEnd(end):
 	# if in a connection we see ((0, 1), (1, 1))
 	# Then I define "stickyEnd" for this pair as (0, 1, 0) and (1, 1, 1), 
@@ -1,11 +1,21 @@
 from collections import defaultdict, OrderedDict
-from multiprocessing import Pool, Process, Manager
-from operator import attrgetter
+from multiprocessing import Pool, Process
+from threading import Semaphore, Event
+from array import array
+from itertools import groupby
+from operator import itemgetter
 import subprocess
+import os
+import shutil
+import tempfile
 import sys
 import time
 import math
 import json
+import heapq
+import pickle
+import hashlib
+import numpy as np
 import stream
 import vg_pb2
 
@@ -189,205 +199,515 @@ def reverse_map(locus_file):
 					allele_reverse_mapping[edge].append([k, i, len(path), len(bubble)])
 	return reverse_mapping, allele_reverse_mapping, alleles_per_pos, locus_branch_mapping
 
+class snarlIndex(object):
+	# Compact, array based version of reverse_mapping and
+	# allele_reverse_mapping, so that the tables can be shared with the
+	# vg_read workers through memory mapped files instead of being pickled.
+	#   nodes:         sorted ids of all nodes inside bubbles
+	#   loci:          bubble ids of node nodes[i], in loci[locusOffsets[i]:locusOffsets[i+1]]
+	#   edges:         sorted edge keys, index(from) * len(nodes) + index(to)
+	#   alleles:       (bubble id, path index, path length) rows of edge edges[j],
+	#                  in alleles[alleleOffsets[j]:alleleOffsets[j+1]]
+	arrays = ('nodes', 'locusOffsets', 'loci', 'edges', 'alleleOffsets', 'alleles')
+
+	def __init__(self, nodes, locusOffsets, loci, edges, alleleOffsets, alleles):
+		self.nodes = nodes
+		self.locusOffsets = locusOffsets
+		self.loci = loci
+		self.edges = edges
+		self.alleleOffsets = alleleOffsets
+		self.alleles = alleles
+
+	@classmethod
+	def build(cls, reverse_mapping, allele_reverse_mapping):
+		nodes = np.array(sorted(reverse_mapping), dtype = np.int64)
+		# Keep the order in which the bubble sets are iterated, the path
+		# building depends on it.
+		locusLists = [list(reverse_mapping[n]) for n in nodes.tolist()]
+		locusOffsets = np.zeros(len(nodes) + 1, dtype = np.int64)
+		locusOffsets[1:] = np.cumsum([len(l) for l in locusLists])
+		loci = np.array([k for l in locusLists for k in l], dtype = np.int64)
+		index = {n: i for i, n in enumerate(nodes.tolist())}
+		keyed = sorted((index[e[0]] * len(nodes) + index[e[1]], e) for e in allele_reverse_mapping)
+		edges = np.array([k for k, e in keyed], dtype = np.int64)
+		alleleOffsets = np.zeros(len(edges) + 1, dtype = np.int64)
+		alleleOffsets[1:] = np.cumsum([len(allele_reverse_mapping[e]) for k, e in keyed])
+		alleles = np.array([a[0:3] for k, e in keyed for a in allele_reverse_mapping[e]], dtype = np.int64).reshape(-1, 3)
+		return cls(nodes, locusOffsets, loci, edges, alleleOffsets, alleles)
+
+	def save(self, directory):
+		for name in self.arrays:
+			np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+
+	@classmethod
+	def load(cls, directory):
+		# Memory mapped, so all workers share the same pages.
+		return cls(*[np.load(os.path.join(directory, name + '.npy'), mmap_mode = 'r') for name in cls.arrays])
+
+	def lookupNodes(self, ids):
+		# Index of each node id in nodes, -1 for nodes outside bubbles.
+		ids = np.asarray(ids, dtype = np.int64)
+		if len(self.nodes) == 0:
+			return np.full(len(ids), -1, dtype = np.int64)
+		pos = np.minimum(np.searchsorted(self.nodes, ids), len(self.nodes) - 1)
+		return np.where(self.nodes[pos] == ids, pos, -1)
+
+	def lookupEdges(self, fromIdx, toIdx):
+		# Index of each edge (as pair of node indices) in edges, -1 if the
+		# edge is not on any bubble path.
+		if len(self.edges) == 0:
+			return np.full(len(fromIdx), -1, dtype = np.int64)
+		keys = fromIdx * len(self.nodes) + toIdx
+		pos = np.minimum(np.searchsorted(self.edges, keys), len(self.edges) - 1)
+		found = (fromIdx >= 0) & (toIdx >= 0) & (self.edges[pos] == keys)
+		return np.where(found, pos, -1)
+
+	def getLoci(self, i):
+		return self.loci[self.locusOffsets[i]:self.locusOffsets[i + 1]].tolist()
+
+	def getAlleles(self, j):
+		return [tuple(a) for a in self.alleles[self.alleleOffsets[j]:self.alleleOffsets[j + 1]].tolist()]
+
+# Bump when the layout of the snarl cache changes, so that old caches are
+# rebuilt instead of misread.
+SNARL_CACHE_VERSION = 1
+
+def snarlCacheKey(locus_file):
+	st = os.stat(locus_file)
+	h = hashlib.sha1()
+	with open(locus_file, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b''):
+			h.update(chunk)
+	return {'version': SNARL_CACHE_VERSION, 'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha1': h.hexdigest()}
+
+def saveBranches(directory, locus_branch_mapping):
+	# locus_branch_mapping as arrays: the paths of bubble branchLoci[i] are
+	# pathOffsets[i] to pathOffsets[i+1], path j is made of the (from, to)
+	# rows edgeOffsets[j] to edgeOffsets[j+1] of branchEdges.
+	paths = [path for bubble in locus_branch_mapping.values() for path in bubble]
+	np.save(os.path.join(directory, 'branchLoci.npy'), np.array(list(locus_branch_mapping), dtype = np.int64))
+	np.save(os.path.join(directory, 'pathOffsets.npy'), getOffsets(np.array([len(b) for b in locus_branch_mapping.values()], dtype = np.int64)))
+	np.save(os.path.join(directory, 'edgeOffsets.npy'), getOffsets(np.array([len(p) for p in paths], dtype = np.int64)))
+	np.save(os.path.join(directory, 'branchEdges.npy'), np.array([e for p in paths for e in p], dtype = np.int64).reshape(-1, 2))
+
+def loadBranches(directory):
+	loci, pathOffsets, edgeOffsets, branchEdges = [np.load(os.path.join(directory, name + '.npy'), mmap_mode = 'r').tolist()
+	                                              for name in ('branchLoci', 'pathOffsets', 'edgeOffsets', 'branchEdges')]
+	paths = [[tuple(e) for e in branchEdges[edgeOffsets[j]:edgeOffsets[j + 1]]] for j in range(len(edgeOffsets) - 1)]
+	locus_branch_mapping = OrderedDict()
+	for i, k in enumerate(loci):
+		locus_branch_mapping[k] = paths[pathOffsets[i]:pathOffsets[i + 1]]
+	return locus_branch_mapping
+
+def snarlCacheDir(cacheDir):
+	# A directory that exists but holds no snarl cache is left alone, the
+	# cache goes in its subdirectory snarls instead.
+	if os.path.isdir(cacheDir) and not os.path.exists(os.path.join(cacheDir, 'key.json')):
+		return os.path.join(cacheDir, 'snarls')
+	return cacheDir
+
+def readSnarls(locus_file, cacheDir = None):
+	# Parse the snarl traversals, or reuse the cache in cacheDir of an
+	# earlier run on the same locus file. Without cacheDir nothing is kept.
+	# Returns alleles_per_pos, locus_branch_mapping and the directory of the
+	# snarl index, which is temporary (and has to be removed by the caller)
+	# if there is no cache.
+	if cacheDir is not None:
+		cacheDir = snarlCacheDir(cacheDir)
+		key = snarlCacheKey(locus_file)
+		try:
+			with open(os.path.join(cacheDir, 'key.json')) as f:
+				cached = json.load(f)
+		except (OSError, ValueError):
+			cached = None
+		if cached == key:
+			print('Reading cached snarl traversals from', cacheDir)
+			locus_branch_mapping = loadBranches(cacheDir)
+			alleles_per_pos = dict()
+			for k, bubble in locus_branch_mapping.items():
+				alleles_per_pos[k] = len(bubble)
+			print('The number of hets:', sum(1 for n in alleles_per_pos.values() if n > 1))
+			return alleles_per_pos, locus_branch_mapping, cacheDir, False
+
+	reverse_mapping, allele_reverse_mapping, alleles_per_pos, locus_branch_mapping = reverse_map(locus_file)
+	index = snarlIndex.build(reverse_mapping, allele_reverse_mapping)
+	del reverse_mapping, allele_reverse_mapping
+	tmpDir = None
+	if cacheDir is not None:
+		try:
+			# Written next to the final place and renamed, with the key last,
+			# so that an interrupted or concurrent run never leaves a cache
+			# that looks valid but is not.
+			parent = os.path.dirname(os.path.abspath(cacheDir))
+			os.makedirs(parent, exist_ok = True)
+			tmpDir = tempfile.mkdtemp(prefix = '.snarlcache', dir = parent)
+		except OSError:
+			pass
+	if tmpDir is None:
+		tmpDir = tempfile.mkdtemp(prefix = 'snarlindex')
+		try:
+			index.save(tmpDir)
+		except:
+			shutil.rmtree(tmpDir, ignore_errors = True)
+			raise
+		return alleles_per_pos, locus_branch_mapping, tmpDir, True
+	oldDir = None
+	try:
+		index.save(tmpDir)
+		saveBranches(tmpDir, locus_branch_mapping)
+		with open(os.path.join(tmpDir, 'key.json'), 'w') as f:
+			json.dump(key, f)
+		# Only an outdated snarl cache is replaced, it is moved aside first
+		# and removed once the new one is in place. Anything else at cacheDir
+		# makes the rename fail and the index is used from the temporary
+		# directory.
+		if os.path.exists(os.path.join(cacheDir, 'key.json')):
+			oldDir = tempfile.mkdtemp(prefix = '.snarlcache', dir = parent)
+			try:
+				os.rename(cacheDir, os.path.join(oldDir, 'old'))
+			except OSError:
+				pass
+		try:
+			os.rename(tmpDir, cacheDir)
+		except OSError:
+			return alleles_per_pos, locus_branch_mapping, tmpDir, True
+	except:
+		shutil.rmtree(tmpDir, ignore_errors = True)
+		raise
+	finally:
+		if oldDir is not None:
+			shutil.rmtree(oldDir, ignore_errors = True)
+	return alleles_per_pos, locus_branch_mapping, cacheDir, False
+
+def asArray(column):
+	# View an array('q') column as an int64 numpy array without copying.
+	if len(column) == 0:
+		return np.zeros(0, dtype = np.int64)
+	return np.frombuffer(column, dtype = np.int64)
+
+def getOffsets(lengths):
+	offsets = np.zeros(len(lengths) + 1, dtype = np.int64)
+	np.cumsum(lengths, out = offsets[1:])
+	return offsets
+
+def uniqueValues(values):
+	# Sorted distinct values, like np.unique. Recent numpy versions use a
+	# hash table for plain np.unique, which is far slower than sorting on
+	# large integer arrays.
+	values = np.sort(values, axis = None)
+	if len(values) == 0:
+		return values
+	return values[np.r_[True, values[1:] != values[:-1]]]
+
+def gatherSegments(lengths, values, order):
+	# Reorder variable length segments of values, the i-th of which has
+	# lengths[i] entries, by order. Return the new offsets and values.
+	offsets = getOffsets(lengths)
+	newOffsets = getOffsets(lengths[order])
+	shift = np.repeat(offsets[:-1][order] - newOffsets[:-1], lengths[order])
+	return newOffsets, values[shift + np.arange(newOffsets[-1], dtype = np.int64)]
+
+class partialStore(object):
+	# Columnar storage of the partial alignments of one sample, in the order
+	# they were read. Partial i has pathLengths[i] nodes and alleleCounts[i]
+	# alleles, stored back to back in nodes, and alleleLoci/alleleIdx.
+	def __init__(self):
+		self.names = []
+		self.query_positions = array('q')
+		self.scores = array('q')
+		self.pathLengths = array('q')
+		self.nodes = array('q')
+		self.alleleCounts = array('q')
+		self.alleleLoci = array('q')
+		self.alleleIdx = array('q')
+
+	def __len__(self):
+		return len(self.names)
+
+	def add(self, partial):
+		self.names.append(partial.name)
+		self.query_positions.append(partial.query_position)
+		self.scores.append(partial.score)
+		self.pathLengths.append(len(partial.path))
+		self.nodes.extend(partial.path)
+		self.alleleCounts.append(len(partial.alleles))
+		for locus, allele in partial.alleles:
+			self.alleleLoci.append(locus)
+			self.alleleIdx.append(allele)
+
+	def extend(self, other):
+		self.names.extend(other.names)
+		self.query_positions.extend(other.query_positions)
+		self.scores.extend(other.scores)
+		self.pathLengths.extend(other.pathLengths)
+		self.nodes.extend(other.nodes)
+		self.alleleCounts.extend(other.alleleCounts)
+		self.alleleLoci.extend(other.alleleLoci)
+		self.alleleIdx.extend(other.alleleIdx)
+
+	def take(self, order):
+		# A new store with the partials reordered (or selected) by order.
+		order = np.asarray(order, dtype = np.int64)
+		store = partialStore()
+		store.names = [self.names[i] for i in order.tolist()]
+		for column in ('query_positions', 'scores', 'pathLengths', 'alleleCounts'):
+			getattr(store, column).frombytes(asArray(getattr(self, column))[order].tobytes())
+		pathLengths = asArray(self.pathLengths)
+		alleleCounts = asArray(self.alleleCounts)
+		store.nodes.frombytes(gatherSegments(pathLengths, asArray(self.nodes), order)[1].tobytes())
+		store.alleleLoci.frombytes(gatherSegments(alleleCounts, asArray(self.alleleLoci), order)[1].tobytes())
+		store.alleleIdx.frombytes(gatherSegments(alleleCounts, asArray(self.alleleIdx), order)[1].tobytes())
+		return store
+
+	def sortOrder(self):
+		# Stable order by (name, query_position).
+		return sorted(range(len(self)), key = lambda i: (self.names[i], self.query_positions[i]))
+
+	def records(self):
+		# Yield (name, query_position, path, alleles) for each partial.
+		o = 0
+		a = 0
+		for i in range(len(self)):
+			l = self.pathLengths[i]
+			c = self.alleleCounts[i]
+			yield (self.names[i], self.query_positions[i], self.nodes[o:o + l].tolist(),
+			       list(zip(self.alleleLoci[a:a + c], self.alleleIdx[a:a + c])))
+			o += l
+			a += c
+
+class readStore(object):
+	# Columnar storage of the reads of one sample after global alignment.
+	# Read i is names[i] and is made of the partials partialOffsets[i] to
+	# partialOffsets[i+1]. Partial j covers nodes[nodeOffsets[j]:nodeOffsets[j+1]].
+	# The alleles of read i are the pairs (alleleLoci[k], alleleIdx[k]) for
+	# k from alleleOffsets[i] to alleleOffsets[i+1].
+	def __init__(self, names = None, partialOffsets = None, nodeOffsets = None, nodes = None, alleleOffsets = None, alleleLoci = None, alleleIdx = None):
+		empty = np.zeros(0, dtype = np.int64)
+		start = np.zeros(1, dtype = np.int64)
+		self.names = names if names is not None else []
+		self.partialOffsets = partialOffsets if partialOffsets is not None else start
+		self.nodeOffsets = nodeOffsets if nodeOffsets is not None else start
+		self.nodes = nodes if nodes is not None else empty
+		self.alleleOffsets = alleleOffsets if alleleOffsets is not None else start
+		self.alleleLoci = alleleLoci if alleleLoci is not None else empty
+		self.alleleIdx = alleleIdx if alleleIdx is not None else empty
+
+	@classmethod
+	def fromReads(cls, reads):
+		# Build from (name, partials, alleles) tuples.
+		names = []
+		partialLengths = []
+		pathLengths = []
+		nodes = array('q')
+		alleleCounts = []
+		alleleLoci = array('q')
+		alleleIdx = array('q')
+		for name, partials, alleles in reads:
+			names.append(name)
+			partialLengths.append(len(partials))
+			for path in partials:
+				pathLengths.append(len(path))
+				nodes.extend(path)
+			alleleCounts.append(len(alleles))
+			for locus, allele in alleles:
+				alleleLoci.append(locus)
+				alleleIdx.append(allele)
+		return cls(names, getOffsets(np.array(partialLengths, dtype = np.int64)),
+		           getOffsets(np.array(pathLengths, dtype = np.int64)), asArray(nodes),
+		           getOffsets(np.array(alleleCounts, dtype = np.int64)), asArray(alleleLoci), asArray(alleleIdx))
+
+	def __len__(self):
+		return len(self.names)
+
+	def filter(self, keepRead, keepNode, keepAllele):
+		# Return a readStore without the reads, node visits and alleles
+		# whose mask is False. Partials emptied by this are kept.
+		partialsPerRead = np.diff(self.partialOffsets)
+		partialRead = np.repeat(np.arange(len(self.names), dtype = np.int64), partialsPerRead)
+		keepPartial = keepRead[partialRead]
+		nodePartial = np.repeat(np.arange(len(partialRead), dtype = np.int64), np.diff(self.nodeOffsets))
+		nodeMask = keepNode & keepPartial[nodePartial]
+		pathLengths = np.bincount(nodePartial[nodeMask], minlength = len(partialRead))[keepPartial]
+		allelesPerRead = np.diff(self.alleleOffsets)
+		alleleRead = np.repeat(np.arange(len(self.names), dtype = np.int64), allelesPerRead)
+		alleleMask = keepAllele & keepRead[alleleRead]
+		alleleCounts = np.bincount(alleleRead[alleleMask], minlength = len(self.names))[keepRead]
+		names = [name for name, k in zip(self.names, keepRead.tolist()) if k]
+		return readStore(names, getOffsets(partialsPerRead[keepRead]), getOffsets(pathLengths), self.nodes[nodeMask],
+		                 getOffsets(alleleCounts), self.alleleLoci[alleleMask], self.alleleIdx[alleleMask])
+
+	def nodeReads(self):
+		# Index of the read each entry of nodes belongs to.
+		readLengths = self.nodeOffsets[self.partialOffsets[1:]] - self.nodeOffsets[self.partialOffsets[:-1]]
+		return np.repeat(np.arange(len(self.names), dtype = np.int64), readLengths)
+
+	def visits(self):
+		# Distinct (node, read) pairs sorted by node then read, with the
+		# number of times the read passes the node and the position in
+		# nodes of the first time.
+		nodeReads = self.nodeReads()
+		order = np.lexsort((nodeReads, self.nodes))
+		if len(order) == 0:
+			empty = np.zeros(0, dtype = np.int64)
+			return empty, empty, empty, empty
+		nodes = self.nodes[order]
+		nodeReads = nodeReads[order]
+		starts = np.r_[0, np.flatnonzero(np.diff(nodes) | np.diff(nodeReads)) + 1]
+		return nodes[starts], nodeReads[starts], np.diff(np.r_[starts, len(order)]), order[starts]
+
+	def bubbleReads(self):
+		# Number of reads passing at least one bubble.
+		return len(uniqueValues(self.nodeReads()[self.nodes < 0]))
+
 class alignmentSets(object):
 	# An object for storing partial alignments from separate individuals.
 	# It does the post-processing on them, including global alignment, repeat
 	# detection and removing, edge building
 	def __init__(self, mode = 'trio'):
 		if mode == 'trio':
-			self.partialList = [[], [], []]
-			self.fullReadList = [[], [], []]
-			self.bubbleReadMap = [defaultdict(set), defaultdict(set), defaultdict(set)]
+			samples = 3
 		elif mode == 'individual':
-			self.partialList = [[]]
-			self.fullReadList = [[]]
-			self.bubbleReadMap = [defaultdict(set)]
+			samples = 1
+		self.partialList = [[] for i in range(samples)]
+		self.fullReadList = [readStore() for i in range(samples)]
 
-	def addPartial(self, partial, sample = 0):
-		self.partialList[sample].append(partial)
+	def addRun(self, run, sample = 0):
+		# A run is a batch of partials sorted by (name, query_position), either
+		# kept as a partialStore or spilled to a file by writeRun. Runs have to
+		# be added in input order.
+		self.partialList[sample].append(run)
 
-	def mergeChunk(self, alignmentSetsObj):
-		for i in range(len(self.partialList)):
-			self.partialList[i].extend(alignmentSetsObj.partialList[i])
+	def postProcessing(self, lowc, highc, t = 1):
+		self.globalAlign(t)
+		self.reportBubbleReads()
+		self.trimRepeat(lowc, highc)
+		self.reportBubbleReads()
 
-	def postProcessing(self, lowc, highc):
+	def globalAlign(self, t = 1):
+		# Gather all the partials of one read name together in the order of
+		# query_position. Samples spilled to disk are merged concurrently, the
+		# workers only get the paths of their runs. Runs held in memory are
+		# merged here, as sending them to workers would copy them.
+		spilled = any(isinstance(run, str) for runs in self.partialList for run in runs)
+		if t > 1 and len(self.partialList) > 1 and spilled:
+			p = Pool(min(t, len(self.partialList)))
+			try:
+				stores = p.map(mergeRuns, self.partialList)
+				p.close()
+				p.join()
+			except:
+				p.terminate()
+				raise
+		else:
+			stores = [mergeRuns(runs) for runs in self.partialList]
 		for sample in range(len(self.partialList)):
-			self.globalAlign(sample)
-		self.getBubbleReadMap()
-		self.trimRepeat(lowc, highc)
-		self.getBubbleReadMap()
-
-	def globalAlign(self, sample):
-		# Gather all the partials of one read name together in the order of 
-		# query_position.
-		self.partialList[sample] = sorted(self.partialList[sample], key=attrgetter('name', 'query_position'))
-		lastname = ''
-		for partial in self.partialList[sample]:
-			if partial.name != lastname:
-				if lastname != '':
-					self.fullReadList[sample].append(read)
-				read = fullRead()
-				read.addPartial(partial)
-			else:
-				
-				read.addPartial(partial)
-			lastname = partial.name
-		self.fullReadList[sample].append(read)
-		print('Sample', sample, 'total read number', len(self.fullReadList[sample]))
-					
-	def depth(self, node):
-		cov = 0
-		for sample in range(len(self.bubbleReadMap)):
-			cov += len(self.bubbleReadMap[sample][node])
-		return cov
-
-	def removeNodeFromRead(self, node, read):
-		for partial in read.partials:
-			pL = len(partial)
-			for i in range(pL):
-				if partial[i] == node:
-					partial[i] = None
-			for i in range(pL):
-				try:
-					partial.remove(None)
-				except:
-					break
-		if node < 0:
-			aL = len(read.alleles)
-			for i in range(aL):
-				if read.alleles[i][0] == node:
-					read.alleles[i] = None
-			for i in range(aL):
-				try:
-					read.alleles.remove(None)
-				except:
-					break
+			self.fullReadList[sample] = stores[sample]
+			self.partialList[sample] = []
+			print('Sample', sample, 'total read number', len(self.fullReadList[sample]))
 
 	def trimRepeat(self, lowc, highc):
+		# Remove reads passing a repeat that is well covered but rarely
+		# repeated within reads, then drop every node/bubble that is either
+		# repeated within too many reads or out of the coverage range.
 		print('Start detecting repeated nodes/bubbles')
-		repeatCollection = defaultdict(int)
-		repeatToRead = defaultdict(list)
-		for sample in range(len(self.fullReadList)):
-			for read in self.fullReadList[sample]:
-				seenNode = defaultdict(int)
-				for partial in read.partials:
-					for node in partial:
-						seenNode[node] += 1
-				for n, c in seenNode.items():
-					if c >= 2:
-						repeatCollection[n] += 1
-						repeatToRead[n].append((read, sample))
+		samples = len(self.fullReadList)
+		# (node, read) pairs of all samples, with the number of times the
+		# read passes the node and the position of the first time.
+		pairNodes, pairSamples, pairReads, pairCounts, pairFirst = [], [], [], [], []
+		shift = 0
+		for sample in range(samples):
+			reads = self.fullReadList[sample]
+			n, r, c, f = reads.visits()
+			pairNodes.append(n)
+			pairReads.append(r)
+			pairCounts.append(c)
+			pairFirst.append(f + shift)
+			pairSamples.append(np.full(len(n), sample, dtype = np.int64))
+			shift += len(reads.nodes)
+		empty = [np.zeros(0, dtype = np.int64)]
+		pairNodes, pairSamples, pairReads, pairCounts, pairFirst = [np.concatenate(c + empty) for c in (pairNodes, pairSamples, pairReads, pairCounts, pairFirst)]
+		nodes, pairIdx = np.unique(pairNodes, return_inverse = True)
+		repeated = pairCounts >= 2
+		repeatCollection = np.bincount(pairIdx[repeated], minlength = len(nodes))
+		# Number of reads of all samples passing each node.
+		depth = np.bincount(pairIdx, minlength = len(nodes))
 		print('Repeat information collected')
-		print('Totally %d repetitive nodes/bubbles found'%len(list(repeatCollection.keys())))
+		print('Totally %d repetitive nodes/bubbles found' % np.count_nonzero(repeatCollection))
 		count = 0
 		child_count = 0
 		threshold = 0.3
 		print('lowc:', lowc, 'highc:', highc)
-		for n, c in repeatCollection.items():
-			cov = self.depth(n)
-			if c / cov < threshold and cov <= highc and cov >= lowc:
-				for (read, sample) in repeatToRead[n]:
-					try:
-						self.fullReadList[sample].remove(read)
-						print('Removing read', read)
-						count += 1
-						if sample == 2:
-							child_count += 1
-					except ValueError:
-						pass
-					
+		ratio = repeatCollection / np.maximum(depth, 1)
+		removing = (repeatCollection > 0) & (ratio < threshold) & (depth <= highc) & (depth >= lowc)
+		removed = [np.zeros(len(self.fullReadList[sample]), dtype = bool) for sample in range(samples)]
+		# Visit the repeats in the order they are first seen, as before.
+		nodeFirst = np.full(len(nodes), shift, dtype = np.int64)
+		np.minimum.at(nodeFirst, pairIdx[repeated], pairFirst[repeated])
+		candidates = np.flatnonzero(repeated & removing[pairIdx])
+		candidates = candidates[np.lexsort((pairFirst[candidates], nodeFirst[pairIdx[candidates]]))]
+		for sample, r in zip(pairSamples[candidates].tolist(), pairReads[candidates].tolist()):
+			if not removed[sample][r]:
+				removed[sample][r] = True
+				print('Removing read', self.fullReadList[sample].names[r])
+				count += 1
+				if sample == 2:
+					child_count += 1
 		print('Totally %d reads removed' % count)
 		print('Totally %d child reads removed' % child_count)
-		del repeatToRead
-		for sample in range(len(self.fullReadList)):
-			for read in self.fullReadList[sample]:
-				for partial in read.partials:
-					pL = len(partial)
-					for i in range(pL):
-						cov = self.depth(partial[i])
-						if repeatCollection[partial[i]] / cov >= threshold or cov <= lowc or cov >= highc:
-							partial[i] = None
-					for i in range(pL):
-						try:
-							partial.remove(None)
-						except:
-							break
-				aL = len(read.alleles)
-				for var in range(aL):
-					cov = self.depth(read.alleles[var][0])
-					if repeatCollection[read.alleles[var][0]] / cov >= threshold or cov <= lowc or cov >= highc:
-						read.alleles[var] = None
-				for var in range(aL):
-					try:
-						read.alleles.remove(None)
-					except:
-						break
-	def getBubbleReadMap(self):
-		if len(self.bubbleReadMap) == 3:
-			self.bubbleReadMap = [defaultdict(set), defaultdict(set), defaultdict(set)]
-		if len(self.bubbleReadMap) == 1:
-			self.bubbleReadMap = [defaultdict(set)]
+		keep = ~((ratio >= threshold) | (depth <= lowc) | (depth >= highc))
+		for sample in range(samples):
+			reads = self.fullReadList[sample]
+			keepNode = keep[np.searchsorted(nodes, reads.nodes)] if len(nodes) else np.zeros(0, dtype = bool)
+			keepAllele = np.zeros(len(reads.alleleLoci), dtype = bool)
+			if len(nodes) > 0:
+				pos = np.minimum(np.searchsorted(nodes, reads.alleleLoci), len(nodes) - 1)
+				keepAllele = (nodes[pos] == reads.alleleLoci) & keep[pos]
+			self.fullReadList[sample] = reads.filter(~removed[sample], keepNode, keepAllele)
+
+	def reportBubbleReads(self):
 		for sample in range(len(self.fullReadList)):
-			bubblereadlist = set()
-			for read in self.fullReadList[sample]:
-				for partial in read.partials:
-					for node in partial:
-						self.bubbleReadMap[sample][node].add(read)
-						if node < 0:
-							bubblereadlist.add(read)
-			print('Sample', sample, 'has', len(bubblereadlist), 'reads associated with bubble')
+			print('Sample', sample, 'has', self.fullReadList[sample].bubbleReads(), 'reads associated with bubble')
 
 	def getEdges(self):
-		edges = set()
+		# Every pair of consecutive nodes in a partial is an edge. Like
+		# before, an edge is kept once, in the reverse orientation of its
+		# first occurrence. Returns the edges as an (n, 2) array.
+		froms = []
+		tos = []
 		for sample in range(len(self.fullReadList)):
-			for read in self.fullReadList[sample]:
-				for partial in read.partials:
-					if len(partial) > 1:
-						for i in range(len(partial)-1):
-							edge1 = (partial[i], partial[i + 1])
-							edge2 = (partial[i + 1], partial[i])
-							if edge1 not in edges:
-								edges.add(edge2)
-		return edges
-
-def coverage(bRM, node):
-	cov = 0
-	for sample in range(len(bRM)):
-		cov += bRM[sample][node]
-	return cov
-
-class fullRead(object):
-	# Object for storing read information after global alignment
-	def __init__(self):
-		self.name = None
-		self.partials = []
-		self.alleles = []
-		self.query_pos = []
-	def addPartial(self, partial):
-		if partial.query_position in self.query_pos:
-			pass
-		else:
-			if self.name != None:
-				assert partial.name == self.name
-			self.name = partial.name
-			self.partials.append(partial.path)
-			self.alleles.extend(partial.alleles)		
-	def __str__(self):
-		return self.name
-	def __repr__(self):
-		return self.name
+			reads = self.fullReadList[sample]
+			inPartial = np.ones(max(len(reads.nodes) - 1, 0), dtype = bool)
+			ends = reads.nodeOffsets[1:-1] - 1
+			inPartial[ends[(ends >= 0) & (ends < len(inPartial))]] = False
+			froms.append(reads.nodes[:-1][inPartial])
+			tos.append(reads.nodes[1:][inPartial])
+		froms = np.concatenate(froms)
+		tos = np.concatenate(tos)
+		low = np.minimum(froms, tos)
+		high = np.maximum(froms, tos)
+		order = np.lexsort((high, low))
+		first = order[np.r_[True, (np.diff(low[order]) != 0) | (np.diff(high[order]) != 0)]] if len(order) else order
+		return np.stack((tos[first], froms[first]), axis = 1)
+
 class partial(object):
-	# Simply parse a line of json content, and store the information.
-	def __init__(self, jsonLine, reverse_mapping, allele_reverse_mapping):
+	# Parse one alignment record, either a serialized vg Alignment message
+	# read from a GAM stream or a line of `vg view -a` json content, and
+	# store the information.
+	__slots__ = ('name', 'score', 'query_position', 'rawMapping', 'path', 'alleles')
+	def __init__(self, record, index, gam = True):
 		self.name = None
 		self.score = 0
 		self.query_position = 0
-		self.rawMapping = []
+		self.rawMapping = [] # node ids along the alignment path
 		self.path = []
 		self.alleles = []
-		self.parseJson(jsonLine)
-		self.getPath(reverse_mapping)
-		self.getAllele(allele_reverse_mapping)
+		if gam:
+			self.parseGam(record)
+		else:
+			self.parseJson(record)
+		nodeIdx = index.lookupNodes(self.rawMapping)
+		self.getPath(index, nodeIdx.tolist())
+		self.getAllele(index, nodeIdx)
 		del self.rawMapping
 	def __str__(self):
 		return self.name
@@ -404,36 +724,47 @@ class partial(object):
 			self.score = int(g['score'])
 		except KeyError:
 			self.score = 0
-		self.rawMapping = g['path']['mapping']
+		self.rawMapping = [int(m['position']['node_id']) for m in g['path']['mapping']]
+
+	def parseGam(self, data):
+		# Decode only the fields of the vg Alignment message used here: name
+		# (3), score (6), query_position (7) and the nodes of the path (2).
+		# The sequence, the qualities and the edits are skipped by length,
+		# which is much faster than parsing the whole message with vg_pb2.
+		for field, value in messageFields(data, 0, len(data)):
+			if field == 3:
+				self.name = data[value[0]:value[1]].decode('utf-8')
+			elif field == 6:
+				self.score = signed(value)
+			elif field == 7:
+				self.query_position = signed(value)
+			elif field == 2:
+				self.rawMapping = pathNodes(data, *value)
 
-	def getPath(self, reverse_mapping):
-		# Get a node based path.
+	def getPath(self, index, nodeIdx):
+		# Get a node based path. nodeIdx holds the position of each node of
+		# the alignment in the snarl index, -1 if it is not in a bubble.
 		if len(self.rawMapping) == 1:
-			node = int(self.rawMapping[0]['position']['node_id'])
-			if node in reverse_mapping:
-				bubble = list(reverse_mapping[node])
-				self.path = bubble
+			if nodeIdx[0] >= 0:
+				self.path = index.getLoci(nodeIdx[0])
 			else:
-				self.path.append(node)
+				self.path.append(self.rawMapping[0])
 		else:
 			for i in range(len(self.rawMapping)):
-				node = int(self.rawMapping[i]['position']['node_id'])
-				if node in reverse_mapping:
-					bubble = reverse_mapping[node]
+				if nodeIdx[i] >= 0:
+					bubble = index.getLoci(nodeIdx[i])
 					if len(bubble) == 1:
 						try:
-							if self.path[-1] == list(bubble)[0]:
+							if self.path[-1] == bubble[0]:
 								continue
 						except IndexError:
 							pass
-						self.path.append(list(bubble)[0])
+						self.path.append(bubble[0])
 					else:
-						bubble = list(bubble)
 						if len(self.path) == 0:
-							nextnode = int(self.rawMapping[i+1]['position']['node_id'])
 							self.path.append(bubble[0])
 							self.path.append(bubble[1])
-							if list(reverse_mapping[nextnode])[0] == bubble[0]:
+							if nodeIdx[i+1] >= 0 and index.getLoci(nodeIdx[i+1])[0] == bubble[0]:
 								self.path.reverse()
 						else:
 							if self.path[-1] == bubble[0]:
@@ -441,25 +772,21 @@ class partial(object):
 							else:
 								self.path.append(bubble[0])
 				else:
-					self.path.append(node)
+					self.path.append(self.rawMapping[i])
 
-	def getAllele(self, allele_reverse_mapping):
+	def getAllele(self, index, nodeIdx):
 		# Get an allele based variant sequence
 		prev_tmp = []
 		prev_locus = -1
 		added = False
+		forward = index.lookupEdges(nodeIdx[:-1], nodeIdx[1:]).tolist()
+		backward = index.lookupEdges(nodeIdx[1:], nodeIdx[:-1]).tolist()
 		for i in range(len(self.rawMapping) - 1):
-			edge1 = (int(self.rawMapping[i]['position']['node_id']), int(self.rawMapping[i+1]['position']['node_id']))
-			edge2 = (int(self.rawMapping[i+1]['position']['node_id']), int(self.rawMapping[i]['position']['node_id']))
-			if edge1 in allele_reverse_mapping or edge2 in allele_reverse_mapping:
-				if edge1 in allele_reverse_mapping:   
-					#qualities = [10]* reverse_mapping[edge1][0][2]
-					qualitie = 1 
-					node_inf = [tuple(i[0:3]) for i in allele_reverse_mapping[edge1]]
+			if forward[i] >= 0 or backward[i] >= 0:
+				if forward[i] >= 0:
+					node_inf = index.getAlleles(forward[i])
 				else:
-					# qualities = [10]* reverse_mapping[edge2][0][2]
-					qualities = 1 
-					node_inf = [tuple(i[0:3]) for i in allele_reverse_mapping[edge2]]
+					node_inf = index.getAlleles(backward[i])
 				tmp = node_inf.copy()
 				if prev_locus != tmp[0][0]:
 					added = False
@@ -469,62 +796,298 @@ class partial(object):
 					continue
 				interset_tmp = list(set(tmp).intersection(set(prev_tmp)))
 				if len(interset_tmp) == 1:
-					qualities = 1 
 					self.alleles.append((interset_tmp[0][0], interset_tmp[0][1]))
 					added = True
 
-def runChunk(jsonLines, sample, reverse_mapping, allele_reverse_mapping, mode, results):
-	
-	alnSet = alignmentSets(mode = mode)
-	for line in jsonLines:
-		alnSet.addPartial(partial(line, reverse_mapping, allele_reverse_mapping), sample)
-	results.append(alnSet)
-
-def getChunk(gamFilecache, threadN):
-	NR = len(gamFilecache)
-	if NR % threadN == 0:
-		chunkSize = 10000
-	else:
-		if NR % threadN != 0:
-			chunkSize = NR // threadN + 1
-		else:
-			chunkSize = NR / threadN
-	chunkSize = 10000
-	chunks = []
-	for i in range(threadN):
-		if (i + 1) * chunkSize <= NR: 
-			chunks.append((i*chunkSize, (i+1)*chunkSize))
+def readVarint(data, pos):
+	# The protobuf varint starting at data[pos], and the position after it.
+	b = data[pos]
+	if b < 0x80:
+		return b, pos + 1
+	result = b & 0x7f
+	shift = 7
+	pos += 1
+	while True:
+		b = data[pos]
+		pos += 1
+		result |= (b & 0x7f) << shift
+		if b < 0x80:
+			return result, pos
+		shift += 7
+
+def skipField(data, pos, wireType):
+	# The position after the value of a field of wireType at data[pos].
+	if wireType == 0:
+		return readVarint(data, pos)[1]
+	if wireType == 2:
+		length, pos = readVarint(data, pos)
+		return pos + length
+	if wireType == 1:
+		return pos + 8
+	if wireType == 5:
+		return pos + 4
+	raise ValueError('Unsupported protobuf wire type %d' % wireType)
+
+def messageFields(data, start, end):
+	# Yield the field number and value of each field of the protobuf message
+	# in data[start:end]. The value is the integer of a varint, the (start,
+	# end) of a length delimited field, and None for fixed width fields.
+	pos = start
+	while pos < end:
+		key, pos = readVarint(data, pos)
+		wireType = key & 7
+		if wireType == 0:
+			value, pos = readVarint(data, pos)
+		elif wireType == 2:
+			length, pos = readVarint(data, pos)
+			value = (pos, pos + length)
+			pos += length
 		else:
-			chunks.append((i*chunkSize, NR))
-	return chunks
+			value = None
+			pos = skipField(data, pos, wireType)
+		yield key >> 3, value
 
-def vg_read(locus_file, gam_file, t, lowc, highc):
-	reverse_mapping, allele_reverse_mapping, alleles_per_pos, locus_branch_mapping = reverse_map(locus_file)
+def findField(data, start, end, key):
+	# The position of the value of the first field with key (field number
+	# << 3 | wire type) in the message in data[start:end], or -1.
+	pos = start
+	while pos < end:
+		k, pos = readVarint(data, pos)
+		if k == key:
+			return pos
+		pos = skipField(data, pos, k & 7)
+	return -1
+
+def pathNodes(data, start, end):
+	# The node ids along a vg Path message in data[start:end], that is the
+	# node_id (1, varint) of the position (1, message) of every mapping (2,
+	# message). A mapping without them is on node 0, as with vg_pb2.
+	nodes = []
+	pos = start
+	while pos < end:
+		key, pos = readVarint(data, pos)
+		if key != 0x12:
+			pos = skipField(data, pos, key & 7)
+			continue
+		length, pos = readVarint(data, pos)
+		node_id = 0
+		position = findField(data, pos, pos + length, 0x0a)
+		if position >= 0:
+			positionLength, position = readVarint(data, position)
+			value = findField(data, position, position + positionLength, 0x08)
+			if value >= 0:
+				node_id = signed(readVarint(data, value)[0])
+		nodes.append(node_id)
+		pos += length
+	return nodes
+
+def signed(value):
+	# int32 and int64 fields are varints of their 64 bit two's complement.
+	return value - (1 << 64) if value >> 63 else value
+
+def alignPartials(store):
+	# Build the reads from the partials of one sample held in memory.
+	order = store.sortOrder()
+	names = [store.names[i] for i in order]
+	order = np.array(order, dtype = np.int64)
+	nodeOffsets, nodes = gatherSegments(asArray(store.pathLengths), asArray(store.nodes), order)
+	alleleCounts = asArray(store.alleleCounts)
+	alleleOffsets, alleleLoci = gatherSegments(alleleCounts, asArray(store.alleleLoci), order)
+	alleleOffsets, alleleIdx = gatherSegments(alleleCounts, asArray(store.alleleIdx), order)
+	starts = [i for i in range(len(names)) if i == 0 or names[i] != names[i - 1]]
+	partialOffsets = np.array(starts + [len(names)], dtype = np.int64)
+	return readStore([names[i] for i in starts], partialOffsets, nodeOffsets, nodes,
+	                 alleleOffsets[partialOffsets], alleleLoci, alleleIdx)
+
+def writeRun(store, path, blockSize = 4096):
+	# Spill a sorted run to disk as a sequence of pickled blocks, so that it
+	# can be read back a block at a time while merging.
+	with open(path, 'wb') as f:
+		for start in range(0, len(store), blockSize):
+			block = store.take(np.arange(start, min(start + blockSize, len(store))))
+			pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+
+def readRun(run):
+	# Yield the records of a run, loading a spilled run one block at a time.
+	if not isinstance(run, str):
+		yield from run.records()
+		return
+	with open(run, 'rb') as f:
+		while True:
+			try:
+				block = pickle.load(f)
+			except EOFError:
+				break
+			yield from block.records()
+
+def groupReads(records):
+	# Turn merged records into (name, partials, alleles) of whole reads.
+	for name, group in groupby(records, key = itemgetter(0)):
+		partials = []
+		alleles = []
+		for record in group:
+			partials.append(record[2])
+			alleles.extend(record[3])
+		yield name, partials, alleles
+
+def mergeRuns(runs):
+	# Merge the sorted runs of one sample into reads. Runs held in memory are
+	# concatenated and sorted again, which Timsort does by merging the runs.
+	# Spilled runs are merged from disk, so only one block per run is held in
+	# memory besides the reads themselves. Both ways keep the partials of
+	# equal (name, query_position) in input order, as heapq.merge is stable.
+	if not any(isinstance(run, str) for run in runs):
+		store = partialStore()
+		for run in runs:
+			store.extend(run)
+		return alignPartials(store)
+	merged = heapq.merge(*[readRun(run) for run in runs], key = itemgetter(0, 1))
+	return readStore.fromReads(groupReads(merged))
+
+def attachIndex(indexDir):
+	# Pool initializer: map the snarl index once per worker.
+	global workerIndex
+	workerIndex = snarlIndex.load(indexDir)
+
+def runChunk(task):
+	# Parse one batch of alignment records and sort it into a run, spilled to
+	# runDir if there is one. Return the run along with the worker pid, the
+	# number of records and the time spent, for the load balance report.
+	start = time.time()
+	seq, records, sample, gam, runDir = task
+	store = partialStore()
+	for record in records:
+		store.add(partial(record, workerIndex, gam))
+	run = store.take(store.sortOrder())
+	if runDir is not None:
+		path = os.path.join(runDir, '%d.run' % seq)
+		writeRun(run, path)
+		run = path
+	return seq, sample, run, os.getpid(), len(records), time.time() - start
+
+def isJson(aln_file):
+	# GAM files are (b)gzipped protobuf streams, while `vg view -a` output
+	# is plain text with one json object per line.
+	with open(aln_file, 'rb') as f:
+		return f.read(1) == b'{'
+
+def readAlignments(aln_file):
+	# Yield the raw alignment records of a GAM file one at a time, or the
+	# lines of a json file converted by `vg view -a`, which is only kept as
+	# a fallback. The file is never loaded as a whole.
+	if isJson(aln_file):
+		with open(aln_file) as f:
+			for line in f:
+				yield line
+	else:
+		with stream.open(str(aln_file), 'rb') as istream:
+			for data in istream:
+				yield data
+
+def getBatchBytes(aln_file, t, minBytes = 1 << 18, maxBytes = 1 << 24):
+	# Size batches from the input size and the number of workers, aiming at
+	# about 8 batches per worker for each file, so that workers which are done
+	# early keep taking batches instead of waiting for the slowest one.
+	size = os.path.getsize(aln_file)
+	return min(maxBytes, max(minBytes, size // (8 * t)))
+
+def getBatches(records, batchBytes):
+	# Cut a stream of alignment records into lists of about batchBytes.
+	batch = []
+	size = 0
+	for record in records:
+		batch.append(record)
+		size += len(record)
+		if size >= batchBytes:
+			yield batch
+			batch = []
+			size = 0
+	if batch:
+		yield batch
+
+def boundedTasks(tasks, slots, stop):
+	# Hold back the next task until the consumer of the results releases a
+	# slot. Otherwise the task feeder of imap_unordered would run ahead and
+	# read the whole input into the task queue.
+	for task in tasks:
+		slots.acquire()
+		if stop.is_set():
+			break
+		yield task
+
+def reportThroughput(stats, wall, t):
+	print('Alignment reading load balance over %d workers:' % t)
+	busy = 0
+	for pid in sorted(stats):
+		batches, records, seconds = stats[pid]
+		busy += seconds
+		rate = records / seconds if seconds > 0 else 0
+		print('Worker %d: %d batches, %d alignments, %.2fs busy, %.0f alignments/s' % (pid, batches, records, seconds, rate))
+	if wall > 0:
+		print('Worker utilization %.1f%% in %.2fs' % (100 * busy / (wall * t), wall))
+
+def vg_read(locus_file, gam_file, t, lowc, highc, maxBatchBytes = 1 << 24, spillDir = None, snarlCache = None):
+	# With spillDir, the sorted runs of partials are written there and merged
+	# from disk, instead of being held in memory until all files are read.
+	# snarlCache is the directory caching the parsed snarl traversals
+	# between runs, see readSnarls.
+	alleles_per_pos, locus_branch_mapping, indexDir, tmpIndex = readSnarls(locus_file, snarlCache)
 	if len(gam_file) == 3:
 		mode = 'trio'
 	elif len(gam_file) == 1:
 		mode = 'individual'
 	totalAlnSet = alignmentSets(mode = mode)
-	for i in range(len(gam_file)):
-		print('Reading', gam_file[i])
-		filecache = open(gam_file[i]).readlines()
-		chunkidx = getChunk(filecache, t)
-		m = Manager()
-		results = m.list()
-		p = Pool(t)
-		processes = []
-		for c in range(len(chunkidx)):
-			processes.append(p.apply_async(runChunk, (filecache[chunkidx[c][0]:chunkidx[c][1]], i, reverse_mapping, allele_reverse_mapping, mode, results)))
-			#p = Process(target = runChunk, args = (filecache[chunkidx[c][0]:chunkidx[c][1]], i, reverse_mapping, allele_reverse_mapping, mode, results))
-			#p.start()
-			#pool.append(p)
-		#for p in pool:
-		#	p.join()
-		p.close()
-		p.join()
-		for i in results:
-			totalAlnSet.mergeChunk(i)
-	totalAlnSet.postProcessing(lowc, highc)
+	runDir = None
+	if spillDir is not None:
+		os.makedirs(spillDir, exist_ok = True)
+		runDir = tempfile.mkdtemp(prefix = 'runs', dir = spillDir)
+
+	def tasks():
+		seq = 0
+		for i in range(len(gam_file)):
+			print('Reading', gam_file[i])
+			gam = not isJson(gam_file[i])
+			batchBytes = getBatchBytes(gam_file[i], t, maxBytes = maxBatchBytes)
+			for batch in getBatches(readAlignments(gam_file[i]), batchBytes):
+				yield (seq, batch, i, gam, runDir)
+				seq += 1
+
+	# Keep at most two batches per worker in flight, so only
+	# O(t * batchBytes) raw records are held in memory at a time.
+	slots = Semaphore(2 * t)
+	stop = Event()
+	stats = defaultdict(lambda: [0, 0, 0.0])
+	# Runs finish in any order, they are added to their sample by seq once
+	# all are done so the partials keep the input order.
+	runs = dict()
+	start = time.time()
+	p = Pool(t, initializer = attachIndex, initargs = (indexDir,))
+	try:
+		try:
+			for seq, sample, run, pid, records, seconds in p.imap_unordered(runChunk, boundedTasks(tasks(), slots, stop)):
+				slots.release()
+				runs[seq] = (run, sample)
+				stats[pid][0] += 1
+				stats[pid][1] += records
+				stats[pid][2] += seconds
+			p.close()
+			p.join()
+		except:
+			stop.set()
+			slots.release()
+			p.terminate()
+			raise
+		finally:
+			if tmpIndex:
+				shutil.rmtree(indexDir, ignore_errors = True)
+		reportThroughput(stats, time.time() - start, t)
+		for seq in sorted(runs):
+			totalAlnSet.addRun(*runs[seq])
+		del runs
+		totalAlnSet.postProcessing(lowc, highc, t)
+	finally:
+		if runDir is not None:
+			shutil.rmtree(runDir, ignore_errors = True)
 	edges = totalAlnSet.getEdges()
 
 	return totalAlnSet, edges, alleles_per_pos, locus_branch_mapping